@@ -0,0 +1,196 @@
+"""
+Headless HTTP API for Echo.
+
+    python api.py                      # threaded dev server on ECHO_API_HOST:ECHO_API_PORT
+    gunicorn -k gthread --threads 16 api:app
+
+Authenticate with POST /api/login, then send the returned token as
+"Authorization: Bearer <token>" (the same signed session tokens the Streamlit
+app uses). The assistant turn itself is chat_service.AssistantTurn, shared
+with app.py.
+
+    POST /api/login                              {"username", "password"} -> {"token", "user_id"}
+    POST /api/logout
+    GET  /api/conversations?scope=public         -> [{"id", "title", "pinned", "archived"}]
+    POST /api/conversations                      {"title"?, "scope"?} -> {"id"}
+    GET  /api/conversations/<id>/messages        ?before_id= | ?after_id= &limit= -> {"messages", "has_more"}
+    POST /api/conversations/<id>/messages        {"content"} -> {"id"}
+    POST /api/conversations/<id>/reply           -> text/event-stream
+    GET  /metrics                                Prometheus text (with ECHO_TRACING=1)
+
+/reply answers the conversation's latest message, which must be from the
+user. It streams "delta" events ({"text"}) as the reply arrives and ends with
+one "done" event ({"message_id", "reply", "prompt_tokens"}) once it has been
+stored; prompt_tokens estimates the request's static and dynamic parts. It
+answers 409 while another request is already replying to the same message
+(or once it has been answered), and 429 (with Retry-After) when the user is
+over their rate limit.
+"""
+import json
+import math
+import os
+
+from flask import Flask, Response, abort, g, jsonify, request
+
+import maintenance
+import tracing
+from chat_service import AssistantTurn, ANSWERED, DUPLICATE, RATE_LIMITED, SLOW_DOWN_MESSAGE
+from echo_api import get_provider, ProviderNotConfigured
+from jobs import start_worker
+from memory import (
+    check_user, create_session, resume_session, end_session, init_db,
+    get_conversation, get_conversation_list, create_conversation,
+    get_messages_page, add_message,
+)
+
+HOST = os.getenv("ECHO_API_HOST", "127.0.0.1")
+PORT = int(os.getenv("ECHO_API_PORT", "8000"))
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+SCOPES = ("public", "private")
+USER_AVATAR = "👤"
+
+app = Flask(__name__)
+
+@app.errorhandler(400)
+@app.errorhandler(401)
+@app.errorhandler(404)
+@app.errorhandler(409)
+@app.errorhandler(503)
+def _json_error(error):
+    return jsonify({"error": error.description}), error.code
+
+# --- AUTH ---
+
+def _bearer_token():
+    header = request.headers.get("Authorization", "")
+    return header[7:].strip() if header.startswith("Bearer ") else None
+
+@app.before_request
+def _authenticate():
+    tracing.start_rerun(f"api.{request.endpoint}")
+    g.user_id = None
+    if request.endpoint in ("login", "metrics"):
+        return
+    session = resume_session(_bearer_token())
+    if session is None:
+        abort(401, "missing or expired session token")
+    g.user_id, g.username = session
+
+@app.teardown_request
+def _end_trace(exc):
+    tracing.end_rerun()
+
+def _body():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400, "expected a JSON object body")
+    return body
+
+def _scope(value):
+    scope = value or "public"
+    if scope not in SCOPES:
+        abort(400, f"scope must be one of {', '.join(SCOPES)}")
+    return scope
+
+def _own_conversation(conversation_id):
+    """The conversation, if it belongs to the caller (404 otherwise, so ids can't be probed)."""
+    convo = get_conversation(conversation_id)
+    if convo is None or convo["user_id"] != g.user_id:
+        abort(404, "no such conversation")
+    return convo
+
+@app.post("/api/login")
+def login():
+    body = _body()
+    user_id = check_user(str(body.get("username", "")).strip(), str(body.get("password", "")))
+    if not user_id:
+        abort(401, "wrong username or password")
+    return jsonify({"token": create_session(user_id), "user_id": user_id})
+
+@app.post("/api/logout")
+def logout():
+    end_session(_bearer_token())
+    return jsonify({"ok": True})
+
+# --- CONVERSATIONS ---
+
+@app.get("/api/conversations")
+def list_conversations():
+    return jsonify(get_conversation_list(g.user_id, _scope(request.args.get("scope"))))
+
+@app.post("/api/conversations")
+def new_conversation():
+    body = _body()
+    title = str(body.get("title") or "New Chat").strip() or "New Chat"
+    conversation_id = create_conversation(g.user_id, title, _scope(body.get("scope")))
+    return jsonify({"id": conversation_id}), 201
+
+@app.get("/api/conversations/<int:conversation_id>/messages")
+def list_messages(conversation_id):
+    _own_conversation(conversation_id)
+    before_id = request.args.get("before_id", type=int)
+    after_id = request.args.get("after_id", type=int)
+    limit = request.args.get("limit", PAGE_SIZE, type=int)
+    if limit < 1:
+        # SQLite reads a negative LIMIT as "no limit".
+        abort(400, "limit must be at least 1")
+    limit = min(limit, MAX_PAGE_SIZE)
+    # One extra row tells us whether there is another page in that direction.
+    page = get_messages_page(conversation_id, before_id=before_id, after_id=after_id, limit=limit + 1)
+    has_more = len(page) > limit
+    page = page[:limit] if after_id is not None else page[-limit:]
+    return jsonify({"messages": page, "has_more": has_more})
+
+@app.post("/api/conversations/<int:conversation_id>/messages")
+def post_message(conversation_id):
+    _own_conversation(conversation_id)
+    content = str(_body().get("content", "")).strip()
+    if not content:
+        abort(400, "content is required")
+    return jsonify({"id": add_message(conversation_id, "user", content, USER_AVATAR)}), 201
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/api/conversations/<int:conversation_id>/reply")
+def reply(conversation_id):
+    convo = _own_conversation(conversation_id)
+    latest = get_messages_page(conversation_id, limit=1)
+    if not latest or latest[0]["role"] != "user":
+        abort(409, "the latest message is not from the user")
+    try:
+        provider = get_provider()
+    except ProviderNotConfigured as e:
+        abort(503, str(e))
+    turn = AssistantTurn(g.user_id, convo["scope"], conversation_id, latest[0], provider)
+    status = turn.begin()
+    if status == DUPLICATE:
+        abort(409, "a reply to this message is already being generated")
+    if status == ANSWERED:
+        abort(409, "the latest message has already been answered")
+    if status == RATE_LIMITED:
+        seconds = math.ceil(turn.retry_after)
+        response = jsonify({"error": SLOW_DOWN_MESSAGE.format(seconds=seconds), "retry_after": seconds})
+        response.headers["Retry-After"] = str(seconds)
+        return response, 429
+
+    def events():
+        for text in turn.stream():
+            yield _sse("delta", {"text": text})
+        yield _sse("done", {"message_id": turn.message_id, "reply": turn.reply, "prompt_tokens": turn.prompt_tokens})
+
+    return Response(events(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache", "X-Accel-Buffering": "no",
+    })
+
+@app.get("/metrics")
+def metrics():
+    return Response(tracing.prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+init_db()
+start_worker()
+maintenance.schedule()
+
+if __name__ == "__main__":
+    app.run(host=HOST, port=PORT, threaded=True)
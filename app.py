@@ -1,18 +1,24 @@
 import streamlit as st
-import google.generativeai as genai
-import json
 from datetime import datetime, timezone
 import html
+import math
 from dotenv import load_dotenv
 import os
-from prompts import get_echo_prompt
+from echo_api import get_provider, ProviderNotConfigured
+from jobs import start_worker
+from chat_service import (
+    AssistantTurn, ASSISTANT_AVATAR, STREAM_RESPONSES, SLOW_DOWN_MESSAGE,
+    READY, DUPLICATE, ANSWERED, wait_for_reply,
+)
 from memory import (
-    add_user, check_user, remember, recall, create_conversation, 
-    get_conversations, get_messages, add_message, get_conversation_title, 
-    update_conversation_title, delete_conversation, init_db, update_password,
-    clear_conversation
+    add_user, check_user, recall, create_conversation, 
+    get_conversations, add_message, get_conversation_title, 
+    delete_conversation, init_db, update_password,
+    clear_conversation, get_messages_page, create_session, resume_session, forget_private
 )
-from ui_components import show_sidebar, show_landing_page
+from ui_components import show_sidebar, show_landing_page, write_session_cookie, SESSION_COOKIE
+import tracing
+import maintenance
 # load custom styles (UI only)
 # load custom styles (UI only)
 if os.path.exists("ui_styles.css"):
@@ -20,10 +26,13 @@ if os.path.exists("ui_styles.css"):
 
 # --- LOAD API KEY FROM .env FILE ---
 load_dotenv()
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
 # --- INITIALIZE DATABASE & CONFIG ---
+tracing.start_rerun("app", st.session_state.get("username"))
+tracing.start_metrics_server()
 init_db()
+start_worker()
+maintenance.schedule()
 st.set_page_config(page_title="Echo", layout="wide", initial_sidebar_state="expanded")
 
 # --- CUSTOM CSS ---
@@ -38,6 +47,8 @@ html, body, [class*="stApp"] {
 </style>
 """, unsafe_allow_html=True)
 
+MESSAGE_PAGE_SIZE = 50  # messages shown when a chat is opened / per "load earlier" or "load newer"
+
 # --- SESSION STATE INITIALIZATION ---
 if "user_id" not in st.session_state: st.session_state.user_id = None
 if "username" not in st.session_state: st.session_state.username = None
@@ -45,6 +56,25 @@ if "private_mode" not in st.session_state: st.session_state.private_mode = False
 if "active_public_convo_id" not in st.session_state: st.session_state.active_public_convo_id = None
 if "active_private_convo_id" not in st.session_state: st.session_state.active_private_convo_id = None
 
+# --- RESTORE SESSION AFTER A REFRESH ---
+# A refresh wipes st.session_state, but the signed session token is kept in a
+# cookie, so the user is restored without another bcrypt login. It is never
+# taken from the URL: a link carrying one would log the victim into someone
+# else's account, and URLs leak through history, logs and Referer headers.
+if not st.session_state.user_id:
+    token = st.context.cookies.get(SESSION_COOKIE)
+    restored = resume_session(token) if token else None
+    if restored:
+        st.session_state.user_id, st.session_state.username = restored
+        st.session_state.session_token = token
+# Bring the cookie in line with the session (set after login, cleared after
+# logout or when it no longer resumes). st.context.cookies is only read when
+# the page connects, so this renders on every run until the next refresh;
+# setting the same cookie again is harmless, and a run cut short by st.rerun()
+# can't lose it.
+if st.session_state.get("session_token") != st.context.cookies.get(SESSION_COOKIE):
+    write_session_cookie(st.session_state.get("session_token"))
+
 # --- AUTHENTICATION / LOGIN PAGE ---
 # --- AUTHENTICATION / LOGIN PAGE ---
 if not st.session_state.user_id:
@@ -72,6 +102,7 @@ if not st.session_state.user_id:
                         if uid:
                             st.session_state.user_id = uid
                             st.session_state.username = user.strip()
+                            st.session_state.session_token = create_session(uid)
                             st.rerun()
                         else:
                             st.error("Wrong username or password.")
@@ -99,7 +130,8 @@ else:
     active_convo_id_key = f"active_{current_scope}_convo_id"
     
     # --- SIDEBAR ---
-    show_sidebar(st.session_state.get(active_convo_id_key))
+    with tracing.span("ui.sidebar"):
+        show_sidebar(st.session_state.get(active_convo_id_key))
     
     # --- MAIN APP LOGIC ---
     conversations = get_conversations(st.session_state.user_id, current_scope)
@@ -115,88 +147,98 @@ else:
     st.title(get_conversation_title(active_conversation_id))
     st.markdown('<div class="app-subtext">Echo listens. Say anything — you’re safe here.</div>', unsafe_allow_html=True)
 
-    if GOOGLE_API_KEY:
-        genai.configure(api_key=GOOGLE_API_KEY)
-        model = genai.GenerativeModel('gemini-pro-latest')
-    else:
+    try:
+        provider = get_provider()
+    except ProviderNotConfigured:
         st.error("API Key is not configured. Please check your .env file.")
         st.stop()
 
-    current_messages = get_messages(active_conversation_id)
-    for message in current_messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    # --- MESSAGE WINDOW ---
+    # Only the latest page is loaded when a chat opens. Later reruns fetch just
+    # the rows added since the last one we have, and "Load earlier messages"
+    # pages backwards by id. A search hit opens a page on either side of the
+    # match instead; "Load newer messages" then pages forwards until the
+    # window reaches the end of the chat again.
+    window = st.session_state.get("message_window")
+    jump_to = st.session_state.pop("jump_to_message", None)
+    if jump_to:
+        before = get_messages_page(active_conversation_id, before_id=jump_to + 1, limit=MESSAGE_PAGE_SIZE + 1)
+        after = get_messages_page(active_conversation_id, after_id=jump_to, limit=MESSAGE_PAGE_SIZE + 1)
+        window = {
+            "conversation_id": active_conversation_id,
+            "has_earlier": len(before) > MESSAGE_PAGE_SIZE,
+            "has_later": len(after) > MESSAGE_PAGE_SIZE,
+            "messages": before[-MESSAGE_PAGE_SIZE:] + after[:MESSAGE_PAGE_SIZE],
+            "highlight_id": jump_to,
+        }
+        st.session_state.message_window = window
+    if not window or window["conversation_id"] != active_conversation_id:
+        page = get_messages_page(active_conversation_id, limit=MESSAGE_PAGE_SIZE + 1)
+        window = {
+            "conversation_id": active_conversation_id,
+            "has_earlier": len(page) > MESSAGE_PAGE_SIZE,
+            "has_later": False,
+            "messages": page[-MESSAGE_PAGE_SIZE:],
+        }
+        st.session_state.message_window = window
+    elif not window["has_later"]:
+        last_id = window["messages"][-1]["id"] if window["messages"] else 0
+        window["messages"] += get_messages_page(active_conversation_id, after_id=last_id, limit=None)
+
+    if window["has_earlier"] and st.button("Load earlier messages"):
+        page = get_messages_page(active_conversation_id, before_id=window["messages"][0]["id"], limit=MESSAGE_PAGE_SIZE + 1)
+        window["has_earlier"] = len(page) > MESSAGE_PAGE_SIZE
+        window["messages"] = page[-MESSAGE_PAGE_SIZE:] + window["messages"]
+        st.rerun()
+
+    current_messages = window["messages"]
+    with tracing.span("ui.render_messages"):
+        for message in current_messages:
+            with st.chat_message(message["role"]):
+                if message["id"] == window.get("highlight_id"):
+                    st.caption("🔎 Search match")
+                st.markdown(message["content"])
+
+    if window["has_later"] and st.button("Load newer messages"):
+        page = get_messages_page(active_conversation_id, after_id=window["messages"][-1]["id"], limit=MESSAGE_PAGE_SIZE + 1)
+        window["has_later"] = len(page) > MESSAGE_PAGE_SIZE
+        window["messages"] += page[:MESSAGE_PAGE_SIZE]
+        st.rerun()
 
     # --- BUG-FREE CHAT LOGIC ---
     
-    # Check if it's the bot's turn to respond
-    if current_messages and current_messages[-1]["role"] == "user":
-        last_prompt = current_messages[-1]["content"]
-        
-        with st.chat_message("assistant", avatar="🤖"):
-            with st.spinner("Thinking..."):
-                try:
-                    # The AI call is now safely inside the try block
-                    user_strengths = recall(st.session_state.user_id, "public", "strengths") or []
-                    user_facts = recall(st.session_state.user_id, current_scope, "facts") or []
-                    context = ""
-                    if user_strengths:
-                        context += f"- User's known strengths: {', '.join(user_strengths)}\n"
-                    if user_facts:
-                        context += f"- Key facts the user has shared: {', '.join(user_facts)}\n"
-
-                    smart_prompt = get_echo_prompt(last_prompt, context)
-                    
-                    response = model.generate_content(smart_prompt)
-                    raw_text = response.text
-
-                    # Robust JSON parser
-                    start = raw_text.find('{')
-                    end = raw_text.rfind('}') + 1
-                    
-                    if start != -1 and end != -1:
-                        clean_json_str = raw_text[start:end]
-                        json_response = json.loads(clean_json_str)
-                        response_text = json_response["response"]
-                        strengths = json_response.get("strengths", [])
-                        facts = json_response.get("facts_learned", [])
-                        
-                        # --- Handle the response ---
-                        if response_text == "INTERRUPT":
-                            interrupt_message = "It sounds like your mind is spinning. Let's try a 30-second pause. I want you to look away from the screen and name one thing in the room that is blue. Take a deep breath."
-                            add_message(active_conversation_id, "assistant", interrupt_message, "🤖")
-                        else:
-                            # --- MEMORY LOGIC ---
-                            if strengths:
-                                remember(st.session_state.user_id, current_scope, "strengths", strengths)
-                            if facts:
-                                remember(st.session_state.user_id, current_scope, "facts", facts)
-                            
-                            add_message(active_conversation_id, "assistant", response_text, "🤖")
-
-                            # --- NEW: INTELLIGENT CHAT NAMING LOGIC ---
-                            # Check if this is the very first exchange in a newly created chat
-                            current_title = get_conversation_title(active_conversation_id)
-                            if (current_title == "New Chat" or current_title.startswith("Chat #")) and len(get_messages(active_conversation_id)) == 2:
-                                title_prompt = f"Summarize the following exchange in 3-5 words to be a chat title. Be concise and relevant. USER: '{last_prompt}' ASSISTANT: '{response_text}'"
-                                title_response = model.generate_content(title_prompt).text
-                                # Clean up the title (remove quotes, etc.) and update the database
-                                new_title = title_response.strip().replace('"', '')
-                                if new_title: # Ensure title is not empty
-                                    update_conversation_title(active_conversation_id, new_title)
-
-                    else: 
-                        # Fallback if no JSON is found
-                        add_message(active_conversation_id, "assistant", raw_text, "🤖")
-
-                except Exception as e:
-                    # This now handles errors from the AI call AND from parsing
-                    error_message = "I'm having a little trouble connecting to my brain right now. Please try again in a moment."
-                    add_message(active_conversation_id, "assistant", error_message, "🤖")
-                    print(f"--- An error occurred during AI call or parsing ---")
-                    print(f"Error: {e}")
-                    print("--------------------------------------------------")
-        st.rerun()
+    # Check if it's the bot's turn to respond (only once the window reaches the end of the chat)
+    if current_messages and not window["has_later"] and current_messages[-1]["role"] == "user":
+        turn = AssistantTurn(st.session_state.user_id, current_scope, active_conversation_id, current_messages[-1], provider)
+        status = turn.begin()
+        if status == READY:
+            with st.chat_message("assistant", avatar=ASSISTANT_AVATAR):
+                if STREAM_RESPONSES:
+                    st.write_stream(turn.stream())
+                else:
+                    with st.spinner("Thinking..."):
+                        reply = "".join(turn.stream(stream=False))
+                    st.markdown(reply)
+            st.rerun()
+        elif status == ANSWERED:
+            # Stored by another tab or process since this window was read;
+            # begin() invalidated the cached messages, so one rerun shows it.
+            st.rerun()
+        elif status == DUPLICATE:
+            # Another tab (or a rerun that overtook this one) is already answering.
+            with st.chat_message("assistant", avatar=ASSISTANT_AVATAR):
+                with st.spinner("Echo is already replying..."):
+                    waited = wait_for_reply(active_conversation_id)
+            if waited:
+                st.rerun()
+            # Otherwise it finished between the two checks; the next rerun picks up where it left off.
+            if st.button("Refresh"):
+                st.rerun()
+        else:
+            # Rate limited: no rerun loop; the next rerun (or the button) tries again.
+            st.warning(SLOW_DOWN_MESSAGE.format(seconds=math.ceil(turn.retry_after)), icon="⏳")
+            if st.button("Try again"):
+                st.rerun()
 
     # Handle the user's new input at the very end
     secret_keyword = recall(st.session_state.user_id, "public", "secret_keyword")
@@ -206,7 +248,13 @@ else:
             st.rerun()
         elif st.session_state.private_mode and prompt.strip().lower() == 'exit':
             st.session_state.private_mode = False
+            forget_private(st.session_state.user_id)
             st.rerun()
         else:
             add_message(active_conversation_id, "user", prompt, "👤")
-            st.rerun()
\ No newline at end of file
+            if window["has_later"]:
+                # Back to the latest page, where the new message is.
+                st.session_state.pop("message_window", None)
+            st.rerun()
+
+tracing.end_rerun()
@@ -0,0 +1,246 @@
+"""
+Storage micro-benchmarks for memory.py.
+
+Seeds a synthetic database (users x conversations x messages), times the
+operations a chat rerun relies on and prints p50/p95/p99 latency and ops/sec.
+Results can be saved as JSON and compared against a stored baseline:
+
+    python bench_memory.py --output before.json
+    # ...make a storage change...
+    python bench_memory.py --baseline before.json --output after.json
+
+The read cache (see READ CACHE in memory.py) is off unless --read-cache is
+given, so the numbers are SQLite's; rerun_reads times the reads of one
+sidebar + chat rerun, the case the cache is for.
+
+Each operation is timed in --repeat rounds (interleaved with the other
+operations) and every statistic is the median over the rounds, so one noisy
+round doesn't move the result. A run exits with status 1 if any operation's
+p95 regressed by more than --threshold against the baseline and by at least
+--min-delta-ms, so run-to-run jitter on sub-millisecond calls isn't reported.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import memory
+
+ROLES = ("user", "assistant")
+WORDS = (
+    "today work exam friend mom sleep tired happy anxious walk music coffee "
+    "painting deadline weekend call stress better proud sorry okay maybe"
+).split()
+
+def _sentence(rng, n=18):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+def seed(users, conversations, messages, rng, victims):
+    """Fill memory.DB_FILE with synthetic data. Returns the ids the benchmarks pick from."""
+    memory.init_db()
+    with memory.connection() as conn:
+        # Password hashing is not what we're measuring; a fixed hash keeps seeding fast.
+        password_hash = memory.bcrypt.hashpw(b"bench", memory.bcrypt.gensalt(4)).decode("utf-8")
+        conn.executemany(
+            "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+            [(f"bench_user_{u}", password_hash) for u in range(users)],
+        )
+        user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+        convo_ids = []
+        for user_id in user_ids:
+            for c in range(conversations):
+                scope = "private" if c % 5 == 4 else "public"
+                cursor = conn.execute(
+                    "INSERT INTO conversations (user_id, title, scope, pinned) VALUES (?, ?, ?, ?)",
+                    (user_id, f"Chat #{c + 1}", scope, int(c % 7 == 0)),
+                )
+                convo_ids.append(cursor.lastrowid)
+            memory._reinforce(conn, user_id, "public", "fact", [_sentence(rng, 4) for _ in range(30)])
+            conn.executemany(
+                "INSERT INTO mood_daily (user_id, scope, period, positive, neutral, negative) VALUES (?, 'public', ?, ?, ?, ?)",
+                [
+                    (user_id, (datetime.date(2024, 1, 1) + datetime.timedelta(days=d)).isoformat(), rng.randint(0, 5), rng.randint(0, 5), rng.randint(0, 5))
+                    for d in range(366)
+                ],
+            )
+        # Extra conversations for delete_conversation to consume.
+        victim_ids = []
+        for _ in range(victims):
+            cursor = conn.execute(
+                "INSERT INTO conversations (user_id, title, scope) VALUES (?, 'victim', 'public')",
+                (rng.choice(user_ids),),
+            )
+            victim_ids.append(cursor.lastrowid)
+        for convo_id in convo_ids + victim_ids:
+            conn.executemany(
+                "INSERT INTO messages (conversation_id, role, content, avatar) VALUES (?, ?, ?, ?)",
+                [(convo_id, ROLES[i % 2], _sentence(rng), "🤖") for i in range(messages)],
+            )
+    return user_ids, convo_ids, victim_ids
+
+def _time(func, args_iter, iterations):
+    samples = []
+    for _ in range(iterations):
+        args = next(args_iter)
+        start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def _summary(samples):
+    ordered = sorted(samples)
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+    total = sum(samples)
+    return {
+        "count": len(samples),
+        "p50_ms": round(pct(50), 4),
+        "p95_ms": round(pct(95), 4),
+        "p99_ms": round(pct(99), 4),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 4),
+        "ops_per_sec": round(len(samples) / total, 1) if total else None,
+    }
+
+def run(args):
+    rng = random.Random(args.seed)
+    print(f"Seeding {args.users} users x {args.conversations} conversations x {args.messages} messages into {memory.DB_FILE} ...")
+    start = time.perf_counter()
+    user_ids, convo_ids, victim_ids = seed(args.users, args.conversations, args.messages, rng, args.iterations * args.repeat)
+    print(f"Seeded in {time.perf_counter() - start:.1f}s")
+
+    def forever(make):
+        while True:
+            yield make()
+
+    any_convo = lambda: (rng.choice(convo_ids),)
+    with memory.connection() as conn:
+        unscored = conn.execute(
+            "SELECT conversation_id, id FROM messages WHERE role = 'user' AND conversation_id IN (SELECT id FROM conversations WHERE title != 'victim')"
+        ).fetchall()
+    rng.shuffle(unscored)
+    unscored = iter(unscored)
+    _unscored = lambda: next(unscored)
+    owners = {}
+    with memory.connection() as conn:
+        owners.update(conn.execute("SELECT id, user_id FROM conversations"))
+
+    def rerun_reads(convo_id):
+        user_id = owners[convo_id]
+        memory.get_conversation_list(user_id, "public")
+        memory.get_conversations(user_id, "public")
+        memory.get_conversation_title(convo_id)
+        memory.get_messages_page(convo_id)
+        memory.recall(user_id, "public", "secret_keyword")
+    victims = iter(victim_ids)
+
+    benchmarks = {
+        "add_message": (memory.add_message, lambda: (rng.choice(convo_ids), "user", _sentence(rng), "👤")),
+        "get_messages": (memory.get_messages, any_convo),
+        "get_messages_page": (memory.get_messages_page, any_convo),
+        "count_messages": (memory.count_messages, any_convo),
+        "get_conversations": (memory.get_conversations, lambda: (rng.choice(user_ids), "public")),
+        # Everything show_sidebar needs per rerun (pinned / archived / renamed titles).
+        "sidebar_conversation_list": (memory.get_conversation_list, lambda: (rng.choice(user_ids), "public")),
+        "get_conversation_title": (memory.get_conversation_title, any_convo),
+        "remember": (memory.remember, lambda: (rng.choice(user_ids), "public", "secret_keyword", _sentence(rng, 1))),
+        "recall": (memory.recall, lambda: (rng.choice(user_ids), "public", "secret_keyword")),
+        "top_facts": (memory.top_facts, lambda: (rng.choice(user_ids), "public", "fact")),
+        "search_messages": (memory.search_messages, lambda: (rng.choice(user_ids), "public", rng.choice(WORDS))),
+        "delete_conversation": (memory.delete_conversation, lambda: (next(victims),)),
+        "record_sentiment": (memory.record_sentiment, lambda: (*_unscored(), rng.choice(("Positive", "Neutral", "Negative")))),
+        # A year of daily mood rollups for the trends page.
+        "get_mood_rollup": (memory.get_mood_rollup, lambda: (rng.choice(user_ids), "public", "day", "2024-01-01", "2025-01-01")),
+        # A handful of users rerunning the same chat, as between two messages.
+        "rerun_reads": (rerun_reads, lambda: (rng.choice(convo_ids[:5]),)),
+    }
+    selected = args.only or list(benchmarks)
+    rounds = {name: [] for name in selected}
+    for _ in range(args.repeat):
+        for name in selected:
+            func, make_args = benchmarks[name]
+            rounds[name].append(_summary(_time(func, forever(make_args), args.iterations)))
+    results = {}
+    for name in selected:
+        results[name] = {key: statistics.median(r[key] for r in rounds[name]) for key in rounds[name][0]}
+        r = results[name]
+        print(f"{name:28s} p50 {r['p50_ms']:9.3f} ms  p95 {r['p95_ms']:9.3f} ms  p99 {r['p99_ms']:9.3f} ms  {r['ops_per_sec']:>10} ops/s")
+    return {
+        "config": {
+            "users": args.users, "conversations": args.conversations, "messages": args.messages,
+            "iterations": args.iterations, "repeat": args.repeat, "seed": args.seed, "read_cache": args.read_cache,
+            "schema_version": len(memory.MIGRATIONS), "sqlite": memory.sqlite3.sqlite_version,
+        },
+        "results": results,
+    }
+
+def compare(current, baseline, threshold, min_delta_ms=0.0):
+    """Print before/after p95 for every operation and return the names that regressed."""
+    regressions = []
+    print(f"\n{'operation':28s} {'base p95':>10s} {'now p95':>10s} {'change':>8s}")
+    for name, now in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before or not before["p95_ms"]:
+            print(f"{name:28s} {'-':>10s} {now['p95_ms']:10.3f}      new")
+            continue
+        change = now["p95_ms"] / before["p95_ms"] - 1
+        flag = ""
+        if change > threshold and now["p95_ms"] - before["p95_ms"] >= min_delta_ms:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:28s} {before['p95_ms']:10.3f} {now['p95_ms']:10.3f} {change:+8.1%}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--conversations", type=int, default=30, help="per user")
+    parser.add_argument("--messages", type=int, default=40, help="per conversation")
+    parser.add_argument("--iterations", type=int, default=500, help="timed calls per operation and round")
+    parser.add_argument("--repeat", type=int, default=3, help="rounds per operation; results are the median round")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", nargs="*", help="run just these operations")
+    parser.add_argument("--read-cache", action="store_true", help="leave memory.py's read cache on")
+    parser.add_argument("--db", help="benchmark database path (default: a fresh temp file)")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.20, help="allowed p95 slowdown vs baseline (0.20 = 20%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=0.1, help="ignore p95 slowdowns smaller than this")
+    args = parser.parse_args(argv)
+
+    memory.READ_CACHE_ENABLED = args.read_cache
+    tmpdir = None
+    if args.db:
+        if os.path.exists(args.db):
+            sys.exit(f"{args.db} already exists; the benchmark needs a fresh database")
+        memory.DB_FILE = args.db
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        memory.DB_FILE = os.path.join(tmpdir.name, "bench.db")
+
+    try:
+        current = run(args)
+    finally:
+        memory.close_connections()
+        if tmpdir:
+            tmpdir.cleanup()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f"\n{len(regressions)} operation(s) regressed more than {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,284 @@
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import tracing
+from context_builder import build_history_context
+from echo_api import JsonFieldStreamer, parse_echo_json, get_provider
+from jobs import enqueue, enqueue_once
+from memory import (
+    add_message, count_messages, get_conversation_title, record_sentiment, top_facts, transaction, conversation_db,
+    acquire_reply_lease, release_reply_lease, reply_lease_expiry, LEASE_ACQUIRED, LEASE_ANSWERED,
+)
+from prompts import get_echo_prompt, prompt_tokens
+
+# --- ASSISTANT TURN ---
+# Everything between "the user has sent a message" and "Echo's reply is
+# stored": building the prompt context, calling the model, parsing the JSON
+# envelope, saving the reply and queueing the background follow-ups. Shared
+# by the Streamlit app (app.py) and the HTTP API (api.py), which only differ
+# in how they show the streamed text.
+
+STREAM_RESPONSES = os.getenv("ECHO_STREAM_RESPONSES", "1") != "0"
+CONTEXT_STRENGTHS = 10  # top-ranked strengths / facts put into each prompt
+CONTEXT_FACTS = 20
+ASSISTANT_AVATAR = "🤖"
+INTERRUPT_MESSAGE = "It sounds like your mind is spinning. Let's try a 30-second pause. I want you to look away from the screen and name one thing in the room that is blue. Take a deep breath."
+ERROR_MESSAGE = "I'm having a little trouble connecting to my brain right now. Please try again in a moment."
+
+# --- ADMISSION CONTROL ---
+# Every turn is a paid model call, so each user gets a token bucket: bursts of
+# up to RATE_LIMIT_BURST turns, refilled at RATE_LIMIT_PER_MINUTE. A turn that
+# finds the bucket empty isn't sent; the user is asked to slow down instead.
+# Buckets live in this process (each app / API server process limits on its own).
+RATE_LIMIT_PER_MINUTE = float(os.getenv("ECHO_RATE_LIMIT_PER_MINUTE", "10"))   # 0 disables the limit
+RATE_LIMIT_BURST = int(os.getenv("ECHO_RATE_LIMIT_BURST", "5"))
+SLOW_DOWN_MESSAGE = "Whoa, that's a lot of messages at once! Give me {seconds} more second(s) to catch my breath, then I'll reply."
+
+class TokenBuckets:
+    """A token bucket per key: `rate` tokens a second, holding at most `burst`."""
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()   # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Spend a token for key. Returns 0.0 if one was available, else the seconds until one will be."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            # A forgotten bucket comes back full, so dropping the least recently used is harmless.
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+_buckets = TokenBuckets(RATE_LIMIT_PER_MINUTE / 60, RATE_LIMIT_BURST)
+
+# --- SINGLE-FLIGHT ---
+# Two tabs, a double rerun or a refresh mid-reply can all see the same
+# unanswered user message. Only the turn that wins begin() calls the model;
+# the others wait for its reply. Sessions of this process meet in _in_flight,
+# other processes in the conversation's reply lease (see REPLY LEASES in memory.py).
+REPLY_LEASE_SECONDS = float(os.getenv("ECHO_REPLY_LEASE_SECONDS", "180"))   # longer than a slow reply, retries included
+WAIT_POLL_SECONDS = 0.25
+READY, DUPLICATE, ANSWERED, RATE_LIMITED = "ready", "duplicate", "answered", "rate_limited"
+
+# conversation_id -> (threading.Event, lapses_at). The event is set once the
+# reply is stored or abandoned; an entry left behind by a turn that was never
+# streamed lapses with its lease.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+def wait_for_reply(conversation_id, timeout=REPLY_LEASE_SECONDS):
+    """
+    Block until nobody is generating a reply in conversation_id (or timeout
+    seconds pass). Returns False if nobody was, without waiting.
+    """
+    deadline = time.monotonic() + timeout
+    entry = _in_flight.get(conversation_id)
+    if entry is not None:
+        entry[0].wait(min(timeout, max(0.0, entry[1] - time.monotonic())))
+        return True
+    waited = False
+    while time.monotonic() < deadline and reply_lease_expiry(conversation_id) is not None:
+        waited = True
+        time.sleep(WAIT_POLL_SECONDS)
+    return waited
+
+def _valid_reply(raw_text):
+    """Whether raw_text is an envelope _store() can save; anything else isn't worth caching."""
+    try:
+        parsed = parse_echo_json(raw_text)
+    except ValueError:
+        return False
+    return isinstance(parsed, dict) and isinstance(parsed.get("response"), str)
+
+def build_context(user_id, scope, conversation_id, before_id):
+    """The "Context" section of Echo's prompt for a reply to message before_id."""
+    user_strengths = top_facts(user_id, "public", "strength", CONTEXT_STRENGTHS)
+    user_facts = top_facts(user_id, scope, "fact", CONTEXT_FACTS)
+    context = ""
+    if user_strengths:
+        context += f"- User's known strengths: {', '.join(user_strengths)}\n"
+    if user_facts:
+        context += f"- Key facts the user has shared: {', '.join(user_facts)}\n"
+    with tracing.span("context.build"):
+        history, needs_summary = build_history_context(conversation_id, before_id=before_id)
+    context += history
+    if needs_summary:
+        enqueue_once("summarize_conversation", {
+            "conversation_id": conversation_id, "cache": scope != "private",
+        })
+    return context
+
+class AssistantTurn:
+    """
+    Echo's reply to the user message `message` ({"id", "content", ...}).
+    Call begin() first: only a READY turn calls the model. Then iterate
+    stream() to get the visible reply text as it arrives; once it is exhausted
+    the reply has been stored and `reply` / `message_id` are set.
+    `prompt_tokens` is the request's estimated {"static", "dynamic"} size.
+    """
+
+    def __init__(self, user_id, scope, conversation_id, message, provider=None):
+        self.user_id = user_id
+        self.scope = scope
+        self.conversation_id = conversation_id
+        self.message = message
+        self.provider = provider or get_provider()
+        self.reply = None
+        self.message_id = None
+        self.error = None
+        self.prompt_tokens = None
+        self.status = None
+        self.retry_after = None
+        self._owner = secrets.token_hex(8)
+        self._leased = False
+        self._flight = None
+
+    def begin(self):
+        """
+        Claim the reply. Returns READY if this turn should generate it,
+        DUPLICATE if another session or process is already answering the
+        message, ANSWERED if one already has (a rerun will show the reply),
+        or RATE_LIMITED if the user is over their limit; then `retry_after`
+        is the number of seconds to wait.
+        """
+        if self.status is not None:
+            return self.status
+        now = time.monotonic()
+        with _in_flight_lock:
+            entry = _in_flight.get(self.conversation_id)
+            if entry is not None and entry[1] > now:
+                self.status = DUPLICATE
+                return self.status
+            self._flight = (threading.Event(), now + REPLY_LEASE_SECONDS)
+            _in_flight[self.conversation_id] = self._flight
+        lease = None
+        try:
+            lease = acquire_reply_lease(self.conversation_id, self.message["id"], self._owner, REPLY_LEASE_SECONDS)
+            self._leased = lease == LEASE_ACQUIRED
+        finally:
+            if not self._leased:
+                self._release()
+        if not self._leased:
+            self.status = ANSWERED if lease == LEASE_ANSWERED else DUPLICATE
+            return self.status
+        # Only a turn that would really call the model spends a token.
+        wait = _buckets.take(self.user_id)
+        if wait:
+            self._release()
+            self.retry_after = wait
+            self.status = RATE_LIMITED
+        else:
+            self.status = READY
+        return self.status
+
+    def _release(self):
+        if self._leased:
+            self._leased = False
+            release_reply_lease(self.conversation_id, self._owner)
+        with _in_flight_lock:
+            # Unless it lapsed and another turn has taken the conversation since.
+            if _in_flight.get(self.conversation_id) is self._flight:
+                del _in_flight[self.conversation_id]
+        if self._flight is not None:
+            self._flight[0].set()
+
+    def stream(self, stream=STREAM_RESPONSES):
+        if self.begin() != READY:
+            return
+        try:
+            yield from self._generate(stream)
+        finally:
+            # Also when the caller stops reading early (e.g. the tab reran
+            # mid-reply): the next rerun may then try again.
+            self._release()
+
+    def _generate(self, stream):
+        # Private chats never go through the shared response cache.
+        cache = self.scope != "private"
+        streamer = JsonFieldStreamer("response")
+        try:
+            context = build_context(self.user_id, self.scope, self.conversation_id, self.message["id"])
+            prompt = get_echo_prompt(self.message["content"], context)
+            self.prompt_tokens = prompt_tokens(prompt)
+            for part, tokens in self.prompt_tokens.items():
+                tracing.count(f"prompt_tokens.{part}", tokens)
+            if stream:
+                chunks = self.provider.stream(prompt.text, system=prompt.system, cache=cache, validate=_valid_reply)
+            else:
+                chunks = [self.provider.generate(prompt.text, system=prompt.system, cache=cache, validate=_valid_reply)]
+            # Show the "response" field as it arrives; the rest of the JSON
+            # envelope is parsed once the stream ends.
+            with tracing.span("llm.stream"):
+                for chunk in chunks:
+                    text = streamer.feed(chunk)
+                    if text:
+                        yield text
+            with tracing.span("json.parse"):
+                parsed = parse_echo_json(streamer.text)
+            if parsed is not None and not (isinstance(parsed, dict) and isinstance(parsed.get("response"), str)):
+                raise ValueError(f"reply envelope has no \"response\" string: {streamer.text[:200]!r}")
+        except Exception as e:
+            # Errors from the AI call and from parsing alike
+            self.error = e
+            self.reply = ERROR_MESSAGE
+            self.message_id = add_message(self.conversation_id, "assistant", ERROR_MESSAGE, ASSISTANT_AVATAR)
+            print("--- An error occurred during AI call or parsing ---")
+            print(f"Error: {e}")
+            print("--------------------------------------------------")
+            yield ERROR_MESSAGE
+            return
+        self._finish(parsed, streamer.text)
+
+    def _finish(self, parsed, raw_text):
+        # The reply and the follow-up jobs it triggers are one unit of work:
+        # a single commit, and a crash can't keep one without the other.
+        with transaction(conversation_db(self.conversation_id)):
+            self._store(parsed, raw_text)
+            release_reply_lease(self.conversation_id, self._owner)
+            self._leased = False
+
+    def _store(self, parsed, raw_text):
+        if parsed is None:
+            # Fallback if no JSON is found
+            self.reply = raw_text
+        elif parsed["response"] == "INTERRUPT":
+            self.reply = INTERRUPT_MESSAGE
+        else:
+            self.reply = parsed["response"]
+        self.message_id = add_message(self.conversation_id, "assistant", self.reply, ASSISTANT_AVATAR)
+        if parsed is None:
+            return
+        record_sentiment(self.conversation_id, self.message["id"], parsed.get("sentiment"))
+        if parsed["response"] == "INTERRUPT":
+            return
+
+        # --- MEMORY LOGIC & CHAT NAMING (background) ---
+        # Neither needs to finish before the reply is shown, so they go to the job queue.
+        strengths = parsed.get("strengths", [])
+        facts = parsed.get("facts_learned", [])
+        if strengths or facts:
+            enqueue("merge_memory", {
+                "user_id": self.user_id, "scope": self.scope,
+                "strengths": strengths, "facts": facts,
+            })
+        # Name a newly created chat after its very first exchange.
+        current_title = get_conversation_title(self.conversation_id)
+        if (current_title == "New Chat" or current_title.startswith("Chat #")) and count_messages(self.conversation_id) == 2:
+            enqueue("title_conversation", {
+                "conversation_id": self.conversation_id,
+                "user_msg": self.message["content"], "reply": self.reply,
+                "cache": self.scope != "private",
+            })
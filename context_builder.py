@@ -0,0 +1,80 @@
+import os
+
+from memory import get_messages_page, get_conversation_summary, save_conversation_summary
+from prompts import CHARS_PER_TOKEN, estimate_tokens, get_summary_prompt
+
+# --- CONVERSATION CONTEXT ---
+# Gives Echo continuity within a chat without letting the prompt grow with it:
+# the last RECENT_TURNS exchanges go in verbatim, everything older is
+# represented by a rolling summary that a background job extends over new
+# messages only, and the whole thing is clipped to a token budget.
+
+RECENT_TURNS = int(os.getenv("ECHO_CONTEXT_RECENT_TURNS", "6"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("ECHO_CONTEXT_TOKEN_BUDGET", "1200"))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("ECHO_SUMMARY_TOKEN_BUDGET", "300"))
+SUMMARY_WORDS = 150
+SUMMARIZE_AFTER = 6      # unsummarised messages behind the window before we ask for a summary
+SUMMARY_BATCH = 200      # most messages folded in by one summary update
+
+def _clip(text, budget):
+    if estimate_tokens(text) <= budget:
+        return text
+    return "…" + text[-budget * CHARS_PER_TOKEN + 1:]
+
+def _format_message(message):
+    speaker = "USER" if message["role"] == "user" else "ECHO"
+    return f"{speaker}: {message['content']}"
+
+def build_history_context(conversation_id, before_id, recent_turns=RECENT_TURNS, budget=HISTORY_TOKEN_BUDGET):
+    """
+    Context lines describing the conversation before message `before_id`.
+    Returns (text, needs_summary); needs_summary means enough messages have
+    fallen out of the verbatim window that the summary should be updated.
+    """
+    summary, through_id = get_conversation_summary(conversation_id)
+    recent = get_messages_page(conversation_id, before_id=before_id, limit=recent_turns * 2)
+    window_start = recent[0]["id"] if recent else before_id
+    # Messages older than the window the summary hasn't caught up with yet.
+    gap = [
+        m for m in get_messages_page(conversation_id, before_id=window_start, limit=SUMMARIZE_AFTER)
+        if m["id"] > through_id
+    ]
+    needs_summary = len(gap) >= SUMMARIZE_AFTER
+
+    parts = []
+    remaining = budget
+    if summary:
+        summary = _clip(summary, min(SUMMARY_TOKEN_BUDGET, remaining))
+        remaining -= estimate_tokens(summary)
+        parts.append(f"- Summary of earlier in this conversation: {summary}\n")
+
+    lines = []
+    for message in reversed(gap + recent):   # newest first, so the budget keeps the latest
+        line = _format_message(message)
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            break
+        remaining -= cost
+        lines.append(line)
+    if lines:
+        lines.reverse()
+        parts.append("- Recent messages in this conversation:\n" + "".join(f"    {line}\n" for line in lines))
+    return "".join(parts), needs_summary
+
+def update_summary(conversation_id, generate):
+    """
+    Fold messages that have left the verbatim window into the stored summary.
+    `generate` is a callable prompt -> text (normally the provider's generate).
+    """
+    summary, through_id = get_conversation_summary(conversation_id)
+    latest = get_messages_page(conversation_id, limit=RECENT_TURNS * 2)
+    if not latest:
+        return
+    window_start = latest[0]["id"]
+    new = [m for m in get_messages_page(conversation_id, after_id=through_id, limit=SUMMARY_BATCH) if m["id"] < window_start]
+    if not new:
+        return
+    prompt = get_summary_prompt(summary, "\n    ".join(_format_message(m) for m in new), SUMMARY_WORDS)
+    updated = generate(prompt).strip()
+    if updated:
+        save_conversation_summary(conversation_id, updated, new[-1]["id"])
@@ -1,24 +1,235 @@
+import hashlib
+import json
+import re
+import threading
+import time
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
 load_dotenv()
 import os
+from llm_cache import CACHE_ENABLED, CachingProvider, ResponseCache
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY") 
-MODEL_NAME = "gemini-pro-latest"
+MODEL_NAME = os.getenv("ECHO_MODEL", "gemini-pro-latest")
 
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
+# --- PROVIDER CONFIG (all overridable from .env) ---
+PROVIDER = os.getenv("ECHO_LLM_PROVIDER", "gemini")          # "gemini" or "fake"
+TEMPERATURE = float(os.getenv("ECHO_TEMPERATURE", "0.7"))
+TIMEOUT_SECONDS = float(os.getenv("ECHO_LLM_TIMEOUT", "60"))
+MAX_ATTEMPTS = int(os.getenv("ECHO_LLM_MAX_ATTEMPTS", "3"))
+FAKE_FIRST_TOKEN_SECONDS = float(os.getenv("ECHO_FAKE_FIRST_TOKEN_SECONDS", "0"))
+FAKE_CHUNK_SECONDS = float(os.getenv("ECHO_FAKE_CHUNK_SECONDS", "0"))
 
-def generate_response(prompt: str, temperature=0.7):
-    # THIS IS THE MOST IMPORTANT TEST:
-    print(f"--- EXECUTING THE *NEW* generate_response FUNCTION! ---")
+# Errors worth retrying: rate limits, overload and timeouts. Anything else
+# (bad request, auth, safety blocks) fails immediately.
+TRANSIENT_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+class ProviderNotConfigured(RuntimeError):
+    pass
+
+class GeminiProvider:
+    """
+    Google Gemini behind the provider interface: generate() and stream().
+    `system` goes in the model's system instruction; there is one model object
+    per distinct instruction, so in practice one per process.
+    """
+
+    def __init__(self, model_name=MODEL_NAME, temperature=TEMPERATURE, timeout=TIMEOUT_SECONDS, max_attempts=MAX_ATTEMPTS):
+        if not GOOGLE_API_KEY:
+            raise ProviderNotConfigured("GOOGLE_API_KEY was not found. Check your .env file and restart.")
+        genai.configure(api_key=GOOGLE_API_KEY)
+        self.model_name = model_name
+        self.temperature = temperature
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self._models = {None: genai.GenerativeModel(model_name)}
+
+    def _model(self, system):
+        model = self._models.get(system)
+        if model is None:
+            model = self._models[system] = genai.GenerativeModel(self.model_name, system_instruction=system)
+        return model
+
+    def _call(self, prompt, stream, temperature, system):
+        retrying = Retrying(
+            stop=stop_after_attempt(self.max_attempts),
+            wait=wait_exponential(multiplier=0.5, max=8),
+            retry=retry_if_exception_type(TRANSIENT_ERRORS),
+            reraise=True,
+        )
+        return retrying(
+            self._model(system).generate_content,
+            prompt,
+            generation_config={"temperature": self.temperature if temperature is None else temperature},
+            request_options={"timeout": self.timeout},
+            stream=stream,
+        )
+
+    def generate(self, prompt, temperature=None, system=None):
+        return self._call(prompt, False, temperature, system).text
+
+    def stream(self, prompt, temperature=None, system=None):
+        # Only opening the stream is retried; a failure mid-stream surfaces to
+        # the caller, who has already shown part of the reply.
+        for chunk in self._call(prompt, True, temperature, system):
+            yield chunk.text
+
+class FakeProvider:
+    """
+    Deterministic offline stand-in for Gemini: no network, no API key.
+    Chat prompts get a well-formed Echo JSON envelope built from the user's
+    message; anything else (e.g. title prompts) gets a short summary. Latency
+    is configurable so the app can be load-tested realistically.
+    """
+
+    model_name = "fake"
+
+    def __init__(self, first_token_seconds=FAKE_FIRST_TOKEN_SECONDS, chunk_seconds=FAKE_CHUNK_SECONDS, chunk_size=16):
+        self.first_token_seconds = first_token_seconds
+        self.chunk_seconds = chunk_seconds
+        self.chunk_size = chunk_size
+
+    def _reply(self, prompt):
+        match = re.search(r'^USER MESSAGE: (".*")\s*$', prompt, re.DOTALL | re.MULTILINE)
+        if not match:
+            words = re.findall(r"[A-Za-z]+", prompt.split("USER:", 1)[-1])
+            return " ".join(words[:4]).title() or "Quiet Chat"
+        user_msg = json.loads(match.group(1)).strip()
+        digest = int(hashlib.sha256(user_msg.encode("utf-8")).hexdigest(), 16)
+        sentiment = ("Positive", "Neutral", "Negative")[digest % 3]
+        return json.dumps({
+            "sentiment": sentiment,
+            "strengths": [],
+            "facts_learned": [],
+            "response": f"I hear you. You said: {user_msg[:200]} How are you feeling about it?",
+        })
+
+    def generate(self, prompt, temperature=None, system=None):
+        time.sleep(self.first_token_seconds)
+        return self._reply(prompt)
 
-    if not GOOGLE_API_KEY:
-        return "Error: GOOGLE_API_KEY was not found. Check your .env file and restart."
-        
+    def stream(self, prompt, temperature=None, system=None):
+        text = self._reply(prompt)
+        time.sleep(self.first_token_seconds)
+        for i in range(0, len(text), self.chunk_size):
+            if i:
+                time.sleep(self.chunk_seconds)
+            yield text[i:i + self.chunk_size]
+
+PROVIDERS = {"gemini": GeminiProvider, "fake": FakeProvider}
+
+_provider = None
+_provider_lock = threading.Lock()
+
+def get_provider():
+    """
+    The process-wide provider, built once from ECHO_LLM_PROVIDER and wrapped
+    in the response cache (see llm_cache.py). generate()/stream() take
+    cache=False to bypass it.
+    """
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                if PROVIDER not in PROVIDERS:
+                    raise ProviderNotConfigured(f"Unknown ECHO_LLM_PROVIDER {PROVIDER!r}")
+                _provider = CachingProvider(
+                    PROVIDERS[PROVIDER](), ResponseCache() if CACHE_ENABLED else None
+                )
+    return _provider
+
+def generate_response(prompt: str, temperature=0.7):
     try:
-        model = genai.GenerativeModel(MODEL_NAME)
-        response = model.generate_content(prompt)
-        return response.text
+        return get_provider().generate(prompt, temperature=temperature)
+    except ProviderNotConfigured as e:
+        return f"Error: {e}"
     except Exception as e:
-        return f"A new API Error occurred: {e}"
\ No newline at end of file
+        return f"A new API Error occurred: {e}"
+
+
+# --- STREAMING JSON FIELD EXTRACTION ---
+# Echo's prompt asks for a JSON envelope ({"sentiment": ..., "response": "..."}).
+# When the reply is streamed we want to show the "response" string as it
+# arrives instead of waiting for the closing brace.
+
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+class JsonFieldStreamer:
+    """
+    Incrementally pulls one top-level string field out of a JSON object that is
+    arriving in chunks. feed() returns the newly decoded part of the field's
+    value (possibly ""), and `text` holds everything received so far.
+    """
+
+    def __init__(self, field="response"):
+        self._key = re.compile(r'(?<!\\)"' + re.escape(field) + r'"\s*:\s*"')
+        self.text = ""
+        self._pos = 0          # next unread index into self.text
+        self._in_value = False
+        self.done = False      # the closing quote of the value has been seen
+
+    def feed(self, chunk):
+        self.text += chunk
+        if self.done:
+            return ""
+        if not self._in_value:
+            match = self._key.search(self.text, max(0, self._pos))
+            if not match:
+                # Keep a tail in case the key is split across chunks.
+                self._pos = max(0, len(self.text) - 64)
+                return ""
+            self._pos = match.end()
+            self._in_value = True
+        return self._decode()
+
+    def _decode(self):
+        out = []
+        text, i = self.text, self._pos
+        while i < len(text):
+            ch = text[i]
+            if ch == '"':
+                self.done = True
+                i += 1
+                break
+            if ch != '\\':
+                out.append(ch)
+                i += 1
+                continue
+            if i + 1 >= len(text):
+                break  # escape split across chunks; wait for more
+            esc = text[i + 1]
+            if esc != 'u':
+                out.append(_ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            if i + 6 > len(text):
+                break
+            code = int(text[i + 2:i + 6], 16)
+            if 0xD800 <= code < 0xDC00:
+                # Surrogate pair: need the low half before emitting anything.
+                if i + 12 > len(text):
+                    break
+                if text[i + 6:i + 8] == '\\u':
+                    low = int(text[i + 8:i + 12], 16)
+                    code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                    i += 6
+            out.append(chr(code))
+            i += 6
+        self._pos = i
+        return "".join(out)
+
+def parse_echo_json(raw_text):
+    """Parse the JSON envelope out of a model reply, or return None if there isn't one."""
+    start = raw_text.find('{')
+    end = raw_text.rfind('}') + 1
+    if start == -1 or end == 0:
+        return None
+    return json.loads(raw_text[start:end])
@@ -0,0 +1,215 @@
+"""
+Export a user's conversations to JSONL or Parquet, and import them back.
+
+    python export_data.py export alice -o alice.jsonl
+    python export_data.py export alice --format parquet --scope public --since 2025-01-01 -o alice.parquet
+    python export_data.py import alice alice.parquet
+
+Rows are streamed from SQLite in chunks of --batch-size, one conversation at
+a time in index order (no sort step), and written as they arrive (Parquet as one record batch per chunk), so memory use
+doesn't depend on how much history the user has. Each output row is one
+message together with its conversation's id, title, scope and creation time.
+"""
+import argparse
+import json
+import sys
+
+import memory
+
+COLUMNS = (
+    "conversation_id", "conversation_title", "scope", "conversation_created_at",
+    "message_id", "role", "content", "avatar", "timestamp", "sentiment",
+)
+BATCH_SIZE = 2000
+
+def iter_export_rows(user_id, scope=None, since=None, until=None, batch_size=BATCH_SIZE):
+    """
+    Yield lists of up to batch_size row dicts for user_id's messages, oldest
+    conversation first. since/until ("YYYY-MM-DD" or full timestamps) bound
+    the message timestamp, inclusive of since and exclusive of until.
+    """
+    # Walk conversations one at a time so each message scan is an index-ordered
+    # read; a single joined "ORDER BY c.id, m.id" would sort everything in a temp b-tree first.
+    convo_sql = "SELECT id, COALESCE(title_override, title), scope, created_at FROM conversations WHERE user_id = ?"
+    convo_params = [user_id]
+    if scope:
+        convo_sql += " AND scope = ?"
+        convo_params.append(scope)
+    message_sql = "SELECT id, role, content, avatar, timestamp, sentiment FROM messages WHERE conversation_id = ?"
+    message_filters = []
+    if since:
+        message_sql += " AND timestamp >= ?"
+        message_filters.append(since)
+    if until:
+        message_sql += " AND timestamp < ?"
+        message_filters.append(until)
+    message_sql += " ORDER BY id"
+
+    batch = []
+    with memory.connection(memory.user_db(user_id)) as conn:
+        conversations = conn.execute(convo_sql + " ORDER BY id", convo_params).fetchall()
+        for convo in conversations:
+            archive = conn.execute(
+                "SELECT codec, payload FROM conversation_archives WHERE conversation_id = ?", (convo[0],)
+            ).fetchone()
+            if archive:
+                # Cold-stored chat: read it from the archive rather than rehydrating it.
+                for row in memory._unpack_archive(*archive):
+                    if (since and row[4] < since) or (until and row[4] >= until):
+                        continue
+                    batch.append(dict(zip(COLUMNS, convo + tuple(row))))
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                continue
+            cursor = conn.execute(message_sql, [convo[0], *message_filters])
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                batch.extend(dict(zip(COLUMNS, convo + row)) for row in rows)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+def export_jsonl(user_id, path, **filters):
+    """Write one JSON object per message to path. Returns the number of rows written."""
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for batch in iter_export_rows(user_id, **filters):
+            f.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in batch)
+            count += len(batch)
+    return count
+
+def _arrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install -r requirements.txt)")
+    return pyarrow
+
+def _arrow_schema(pa):
+    return pa.schema([
+        ("conversation_id", pa.int64()), ("conversation_title", pa.string()),
+        ("scope", pa.string()), ("conversation_created_at", pa.string()),
+        ("message_id", pa.int64()), ("role", pa.string()), ("content", pa.string()),
+        ("avatar", pa.string()), ("timestamp", pa.string()), ("sentiment", pa.string()),
+    ])
+
+def export_parquet(user_id, path, **filters):
+    """Write the same rows as export_jsonl as a Parquet file, one record batch per chunk."""
+    pa = _arrow()
+    schema = _arrow_schema(pa)
+    count = 0
+    with pa.parquet.ParquetWriter(path, schema, compression="zstd") as writer:
+        for batch in iter_export_rows(user_id, **filters):
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+            count += len(batch)
+        if count == 0:
+            writer.write_table(schema.empty_table())
+    return count
+
+def iter_jsonl(path, batch_size=BATCH_SIZE):
+    batch = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+def iter_parquet(path, batch_size=BATCH_SIZE):
+    pa = _arrow()
+    for record_batch in pa.parquet.ParquetFile(path).iter_batches(batch_size=batch_size):
+        yield record_batch.to_pylist()
+
+def import_rows(user_id, batches):
+    """
+    Recreate exported conversations under user_id. Each source conversation
+    becomes a new conversation (ids are reassigned); one transaction per batch.
+    Messages with a sentiment are counted in the mood rollups as well.
+    Returns (conversations, messages) created.
+    """
+    conversation_map = {}
+    messages = 0
+    with memory.connection(memory.user_db(user_id)) as conn:
+        for batch in batches:
+            rows = []
+            for row in batch:
+                source_id = row["conversation_id"]
+                if source_id not in conversation_map:
+                    cursor = conn.execute(
+                        "INSERT INTO conversations (id, user_id, title, scope, created_at) VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))",
+                        (
+                            memory._allocate_conversation_id(user_id), user_id,
+                            row["conversation_title"] or "Imported Chat", row["scope"], row["conversation_created_at"],
+                        ),
+                    )
+                    conversation_map[source_id] = (cursor.lastrowid, row["scope"])
+                rows.append((conversation_map[source_id][0], row["role"], row["content"], row["avatar"], row["timestamp"], row.get("sentiment")))
+            conn.executemany(
+                "INSERT INTO messages (conversation_id, role, content, avatar, timestamp, sentiment) VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?)",
+                rows,
+            )
+            for row in batch:
+                if row.get("sentiment") and row["timestamp"]:
+                    memory._add_to_mood_rollups(conn, user_id, conversation_map[row["conversation_id"]][1], row["timestamp"], row["sentiment"])
+            conn.commit()
+            messages += len(rows)
+    return len(conversation_map), messages
+
+def _user_id(username):
+    with memory.connection() as conn:
+        row = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+    if not row:
+        sys.exit(f"No such user: {username}")
+    return row[0]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or re-import a user's conversations.")
+    parser.add_argument("--db", help=f"database file (default: {memory.DB_FILE})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="stream a user's messages to a file")
+    export.add_argument("username")
+    export.add_argument("-o", "--output", required=True)
+    export.add_argument("--format", choices=("jsonl", "parquet"), help="default: from the output file extension")
+    export.add_argument("--scope", choices=("public", "private"))
+    export.add_argument("--since", help="only messages at or after this date/time")
+    export.add_argument("--until", help="only messages before this date/time")
+    export.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    restore = commands.add_parser("import", help="load an export back in under a user")
+    restore.add_argument("username")
+    restore.add_argument("input")
+    restore.add_argument("--format", choices=("jsonl", "parquet"))
+    restore.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+
+    args = parser.parse_args(argv)
+    if args.db:
+        memory.DB_FILE = args.db
+    memory.init_db()
+    user_id = _user_id(args.username)
+
+    if args.command == "export":
+        fmt = args.format or ("parquet" if args.output.endswith(".parquet") else "jsonl")
+        writer = export_parquet if fmt == "parquet" else export_jsonl
+        count = writer(
+            user_id, args.output, scope=args.scope, since=args.since, until=args.until, batch_size=args.batch_size,
+        )
+        print(f"Exported {count} messages to {args.output}")
+    else:
+        fmt = args.format or ("parquet" if args.input.endswith(".parquet") else "jsonl")
+        reader = iter_parquet if fmt == "parquet" else iter_jsonl
+        conversations, messages = import_rows(user_id, reader(args.input, args.batch_size))
+        print(f"Imported {messages} messages into {conversations} conversations for {args.username}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
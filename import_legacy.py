@@ -0,0 +1,295 @@
+"""
+Import the legacy memory.json into echo.db.
+
+    python import_legacy.py memory.json
+
+The file is read as a stream: only one leaf value (a message, a list of
+strengths, ...) is held in memory at a time, so multi-GB dumps import in
+constant memory. Rows are written with executemany in batches of
+--batch-size, one transaction per batch.
+
+Re-running is safe. Progress is tracked per (file, user) in
+legacy_import_progress: users that finished are skipped, and a user that was
+interrupted half-way has their partial import removed and redone.
+"""
+import argparse
+import json
+import os
+import sys
+
+import memory
+
+# --- STREAMING JSON READER ---
+
+class JsonStream:
+    """
+    A pull parser over a text file. iter_object()/iter_array() walk containers
+    one member at a time; read_value() decodes a single (small) value whole.
+    """
+
+    CHUNK = 1 << 16
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.CHUNK)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise ValueError(f"expected {ch!r} in JSON, found {self.peek()!r}")
+        self.pos += 1
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number or literal that ends exactly at the buffer edge may continue in the next chunk.
+            if end == len(self.buf) and not self.eof and not isinstance(value, (dict, list, str)):
+                if self._fill():
+                    continue
+            self.pos = end
+            return value
+
+    def _members(self, close):
+        first = True
+        while True:
+            if self.peek() == close:
+                self.pos += 1
+                return
+            if not first:
+                self.expect(",")
+            first = False
+            yield
+
+    def iter_object(self):
+        """Yield each key; the caller must consume the value before asking for the next key."""
+        self.expect("{")
+        for _ in self._members("}"):
+            key = self.read_value()
+            self.expect(":")
+            yield key
+
+    def iter_array(self):
+        """Yield once per element; the caller must consume the element."""
+        self.expect("[")
+        for _ in self._members("]"):
+            yield
+
+    def skip_value(self):
+        ch = self.peek()
+        if ch == "{":
+            for _ in self.iter_object():
+                self.skip_value()
+        elif ch == "[":
+            for _ in self.iter_array():
+                self.skip_value()
+        else:
+            self.read_value()
+
+# --- IMPORTER ---
+
+SCOPES = ("public", "private")
+CHAT_KEYS = ("chat_history",)
+MEMORY_KEYS = ("interests", "mood_history", "secret_keyword")
+
+class LegacyImporter:
+    def __init__(self, source, batch_size=5000):
+        self.source = os.path.abspath(source)
+        self.batch_size = batch_size
+        self.pending = 0
+        self.stats = {"users": 0, "skipped": 0, "messages": 0, "memories": 0, "strengths": 0}
+
+    # Each batch is its own transaction: flush() commits whatever has been
+    # written through self.conn since the last flush.
+    def _count(self, n=1):
+        self.pending += n
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def run(self):
+        memory.init_db()
+        with memory.connection() as conn, open(self.source, encoding="utf-8") as f:
+            self.conn = conn
+            stream = JsonStream(f)
+            for username in stream.iter_object():
+                if stream.peek() != "{":
+                    stream.skip_value()
+                    continue
+                self._import_user(stream, username)
+            self.flush()
+        return self.stats
+
+    def _progress(self, username):
+        return self.conn.execute(
+            "SELECT user_id, conversation_ids, created_user, done FROM legacy_import_progress WHERE source = ? AND username = ?",
+            (self.source, username),
+        ).fetchone()
+
+    def _import_user(self, stream, username):
+        progress = self._progress(username)
+        if progress and progress[3]:
+            stream.skip_value()
+            self.stats["skipped"] += 1
+            return
+        if progress:
+            # Interrupted last time: undo the partial import and start this user over.
+            for convo_id in json.loads(progress[1]):
+                self.conn.execute("DELETE FROM conversations WHERE id = ?", (convo_id,))
+            created_user = bool(progress[2])
+        else:
+            created_user = False
+
+        row = self.conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+        if row:
+            user_id = row[0]
+        else:
+            # No usable password until (unless) the dump provides one.
+            cursor = self.conn.execute(
+                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                (username, memory.UNUSABLE_PASSWORD_HASH),
+            )
+            user_id = cursor.lastrowid
+            created_user = True
+        self.user_id = user_id
+        self.username = username
+        self.created_user = created_user
+        self.conversations = {}
+        self._save_progress(done=False)
+        self.flush()
+
+        # Keys outside "public"/"private" predate scopes and belong to public.
+        for key in stream.iter_object():
+            if key in SCOPES and stream.peek() == "{":
+                for scoped_key in stream.iter_object():
+                    self._import_key(stream, key, scoped_key)
+            else:
+                self._import_key(stream, "public", key)
+
+        self._save_progress(done=True)
+        self.flush()
+        self.stats["users"] += 1
+
+    def _save_progress(self, done):
+        self.conn.execute("""
+            INSERT INTO legacy_import_progress (source, username, user_id, conversation_ids, created_user, done)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (source, username) DO UPDATE SET
+                user_id = excluded.user_id, conversation_ids = excluded.conversation_ids,
+                created_user = excluded.created_user, done = excluded.done
+        """, (self.source, self.username, self.user_id, json.dumps(list(self.conversations.values())), int(self.created_user), int(done)))
+
+    def _conversation(self, scope):
+        if scope not in self.conversations:
+            cursor = self.conn.execute(
+                "INSERT INTO conversations (user_id, title, scope) VALUES (?, ?, ?)",
+                (self.user_id, "Imported chat history", scope),
+            )
+            self.conversations[scope] = cursor.lastrowid
+            # Record it in the same transaction so a crash can't orphan it.
+            self._save_progress(done=False)
+        return self.conversations[scope]
+
+    def _import_key(self, stream, scope, key):
+        if key in CHAT_KEYS and stream.peek() == "[":
+            batch = []
+            for _ in stream.iter_array():
+                message = stream.read_value()
+                if not isinstance(message, dict) or not message.get("content"):
+                    continue
+                batch.append((self._conversation(scope), message.get("role", "user"), str(message["content"]), message.get("avatar")))
+                if len(batch) >= self.batch_size:
+                    self._write_messages(batch)
+                    batch = []
+            self._write_messages(batch)
+        elif key == "password":
+            password = stream.read_value()
+            # Never overwrite the password of an account that already existed in echo.db.
+            if self.created_user and isinstance(password, str) and password:
+                self.conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (memory.hash_password(password), self.user_id))
+                self._count()
+        elif key == "strengths":
+            strengths = stream.read_value()
+            if isinstance(strengths, list):
+                self._write_strengths(scope, strengths)
+        elif key in MEMORY_KEYS:
+            value = stream.read_value()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO memories (user_id, scope, key, value) VALUES (?, ?, ?, ?)",
+                (self.user_id, scope, key, json.dumps(value)),
+            )
+            self.stats["memories"] += 1
+            self._count()
+        else:
+            stream.skip_value()
+
+    def _write_messages(self, batch):
+        if not batch:
+            return
+        self.conn.executemany("INSERT INTO messages (conversation_id, role, content, avatar) VALUES (?, ?, ?, ?)", batch)
+        self.stats["messages"] += len(batch)
+        self._count(len(batch))
+
+    def _write_strengths(self, scope, strengths):
+        rows = []
+        for item in strengths:
+            key = memory.normalize_fact(item)
+            if key:
+                rows.append((self.user_id, scope, str(item).strip(), key))
+        # INSERT OR IGNORE rather than reinforcing, so importing twice doesn't inflate hit counts.
+        self.conn.executemany("""
+            INSERT OR IGNORE INTO user_facts (user_id, scope, kind, text, norm_key, first_seen, last_seen)
+            VALUES (?, ?, 'strength', ?, ?, strftime('%s', 'now'), strftime('%s', 'now'))
+        """, rows)
+        self.stats["strengths"] += len(rows)
+        self._count(len(rows))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import the legacy memory.json into echo.db.")
+    parser.add_argument("source", nargs="?", default="memory.json")
+    parser.add_argument("--db", help=f"target database (default: {memory.DB_FILE})")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows per transaction")
+    args = parser.parse_args(argv)
+    if args.db:
+        memory.DB_FILE = args.db
+    elif memory.SHARD_DIR:
+        sys.exit("Import into an unsharded echo.db (--db), then split it with shard_tool.py.")
+    stats = LegacyImporter(args.source, args.batch_size).run()
+    print(
+        f"Imported {stats['users']} user(s) ({stats['skipped']} already done): "
+        f"{stats['messages']} messages, {stats['memories']} memories, {stats['strengths']} strengths."
+    )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,30 @@
-from memory import init_db
+import sys
+from memory import init_db, schema_version, connection, check_query_plans, rebuild_search_index, cold_storage_stats, all_db_files
 
 init_db()
-print("Database has been successfully upgraded with new conversation tables!")
\ No newline at end of file
+with connection() as conn:
+    print(f"Database is at schema version {schema_version(conn)}.")
+
+cold = {}
+for db_file in all_db_files():
+    for key, value in cold_storage_stats(db_file).items():
+        cold[key] = cold.get(key, 0) + value
+if cold["conversations"]:
+    print(
+        f"Cold storage: {cold['conversations']} archived conversations, {cold['messages']} messages, "
+        f"{cold['packed_bytes'] / 1024:,.0f} KB packed ({cold['saved_bytes'] / 1024:,.0f} KB saved)."
+    )
+
+if "--rebuild-search" in sys.argv:
+    for db_file in all_db_files():
+        rebuild_search_index(db_file)
+    print("Message search index rebuilt.")
+
+if "--check-plans" in sys.argv:
+    import jobs  # noqa: F401  (registers the job queue's hot query)
+    problems = check_query_plans()
+    for name, steps in problems.items():
+        print(f"FULL SCAN in {name}: {'; '.join(steps)}")
+    if problems:
+        sys.exit(1)
+    print("All hot queries are index-backed.")
@@ -0,0 +1,185 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from memory import connection, transaction, on_commit, init_db, reinforce_facts, get_conversation_title, update_conversation_title, user_db, HOT_QUERIES
+
+# --- BACKGROUND JOB QUEUE ---
+# Work that doesn't have to finish before the user sees Echo's reply (chat
+# titles, memory merges, ...) is queued here instead of running inline.
+# Jobs are rows in the `jobs` table, so they survive restarts; a small
+# process-wide thread pool runs them, and the UI just sees the results on its
+# next rerun.
+
+WORKERS = int(os.getenv("ECHO_JOB_WORKERS", "2"))
+POLL_SECONDS = 1.0
+LEASE_SECONDS = 300      # a "running" job older than this is assumed orphaned
+MAX_ATTEMPTS = 3
+
+HANDLERS = {}
+
+_wake = threading.Event()
+_start_lock = threading.Lock()
+_dispatcher = None
+
+def job_handler(kind):
+    """Register the decorated function as the handler for jobs of this kind."""
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+def enqueue(kind, payload, delay=0):
+    """Queue a job and return its id. payload must be JSON-serialisable."""
+    with connection() as conn:
+        cursor = conn.execute(
+            "INSERT INTO jobs (kind, payload, run_after) VALUES (?, ?, ?)",
+            (kind, json.dumps(payload), time.time() + delay),
+        )
+        job_id = cursor.lastrowid
+    # Inside a caller's transaction the row isn't visible to the dispatcher until that commits.
+    on_commit(_wake.set)
+    return job_id
+
+def enqueue_once(kind, payload, delay=0):
+    """Like enqueue(), but a no-op if an identical job is already pending or running."""
+    with connection() as conn:
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE status IN ('pending', 'running') AND kind = ? AND payload = ?",
+            (kind, json.dumps(payload)),
+        ).fetchone()
+    return row[0] if row else enqueue(kind, payload, delay)
+
+def job_status(job_id):
+    with connection() as conn:
+        row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return row[0] if row else None
+
+_NEXT_JOB_SQL = "SELECT id, kind, payload FROM jobs WHERE status = 'pending' AND run_after <= ? ORDER BY run_after LIMIT 1"
+HOT_QUERIES["claim_job"] = (_NEXT_JOB_SQL, (0,))
+
+def _claim():
+    """Atomically move the next due job to "running" and return (id, kind, payload)."""
+    now = time.time()
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # Jobs left "running" by a crashed process go back on the queue.
+        conn.execute(
+            "UPDATE jobs SET status = 'pending' WHERE status = 'running' AND claimed_at < ?",
+            (now - LEASE_SECONDS,),
+        )
+        row = conn.execute(_NEXT_JOB_SQL, (now,)).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (now, row[0]),
+            )
+    return row
+
+def _run(job_id, kind, payload):
+    try:
+        handler = HANDLERS.get(kind)
+        if handler is None:
+            raise LookupError(f"no handler registered for job kind {kind!r}")
+        handler(**json.loads(payload))
+    except Exception as e:
+        with connection() as conn:
+            attempts = conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            if attempts >= MAX_ATTEMPTS:
+                conn.execute("UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ?", (str(e), job_id))
+            else:
+                conn.execute(
+                    "UPDATE jobs SET status = 'pending', last_error = ?, run_after = ? WHERE id = ?",
+                    (str(e), time.time() + 2 ** attempts, job_id),
+                )
+        print(f"--- Background job {job_id} ({kind}) failed: {e}")
+    else:
+        # Finished jobs are dropped rather than kept as history.
+        with connection() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+def _dispatch_loop(executor, slots):
+    while True:
+        slots.acquire()
+        try:
+            job = _claim()
+        except Exception as e:
+            # Most likely "database is locked"; this thread must not die, or
+            # no job would run again until the process restarts.
+            slots.release()
+            print(f"--- Job dispatcher couldn't claim a job: {e}")
+            time.sleep(POLL_SECONDS)
+            continue
+        if job is None:
+            slots.release()
+            _wake.wait(POLL_SECONDS)
+            _wake.clear()
+            continue
+        future = executor.submit(_run, *job)
+        future.add_done_callback(lambda _: slots.release())
+
+def start_worker():
+    """Start the process-wide job dispatcher (safe to call on every rerun)."""
+    global _dispatcher
+    with _start_lock:
+        if _dispatcher is not None:
+            return
+        init_db()
+        executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="echo-job")
+        slots = threading.BoundedSemaphore(WORKERS)
+        _dispatcher = threading.Thread(
+            target=_dispatch_loop, args=(executor, slots), name="echo-job-dispatcher", daemon=True
+        )
+        _dispatcher.start()
+
+# --- JOB HANDLERS ---
+
+@job_handler("merge_memory")
+def merge_memory(user_id, scope, strengths=(), facts=()):
+    """Fold a turn's strengths / facts_learned into what we already know about the user."""
+    with transaction(user_db(user_id)):  # one transaction for both kinds
+        if strengths:
+            reinforce_facts(user_id, scope, "strength", strengths)
+        if facts:
+            reinforce_facts(user_id, scope, "fact", facts)
+
+@job_handler("title_conversation")
+def title_conversation(conversation_id, user_msg, reply, cache=True):
+    """Name a new chat from its first exchange, unless it has been titled meanwhile."""
+    from echo_api import get_provider
+
+    current_title = get_conversation_title(conversation_id)
+    if current_title is None or not (current_title == "New Chat" or current_title.startswith("Chat #")):
+        return
+    title_prompt = f"Summarize the following exchange in 3-5 words to be a chat title. Be concise and relevant. USER: '{user_msg}' ASSISTANT: '{reply}'"
+    title_response = get_provider().generate(title_prompt, cache=cache)
+    # Clean up the title (remove quotes, etc.)
+    new_title = title_response.strip().replace('"', '')
+    if new_title:
+        update_conversation_title(conversation_id, new_title)
+
+@job_handler("summarize_conversation")
+def summarize_conversation(conversation_id, cache=True):
+    """Extend a chat's rolling summary over the messages that left the verbatim window."""
+    from context_builder import update_summary
+    from echo_api import get_provider
+
+    update_summary(conversation_id, lambda prompt: get_provider().generate(prompt, cache=cache))
+
+@job_handler("maintenance")
+def run_maintenance():
+    """Periodic database upkeep (maintenance.py); queues its own next run, even if this one fails."""
+    import maintenance
+    from memory import all_db_files
+
+    try:
+        for db_file in all_db_files():
+            print(maintenance.format_report(maintenance.run_maintenance(db_file)))
+    finally:
+        # Once per run, not per retry: a failed attempt has already queued it.
+        with connection() as conn:
+            queued = conn.execute("SELECT 1 FROM jobs WHERE kind = 'maintenance' AND status = 'pending'").fetchone()
+        if maintenance.INTERVAL_SECONDS > 0 and not queued:
+            enqueue("maintenance", {}, delay=maintenance.INTERVAL_SECONDS)
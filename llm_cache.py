@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from memory import connection
+from tracing import traced
+
+# --- LLM RESPONSE CACHE ---
+# Retries, Streamlit double-submits and re-issued title prompts send the exact
+# same request more than once. Responses are cached under a hash of
+# (model, prompt, generation params): first in an in-process LRU, and
+# optionally in the llm_cache table so other processes / restarts share them.
+
+CACHE_ENABLED = os.getenv("ECHO_LLM_CACHE", "1") != "0"
+CACHE_TTL_SECONDS = float(os.getenv("ECHO_LLM_CACHE_TTL", "3600"))
+CACHE_MAX_ENTRIES = int(os.getenv("ECHO_LLM_CACHE_SIZE", "512"))
+CACHE_DB_TIER = os.getenv("ECHO_LLM_CACHE_DB", "0") == "1"
+CACHE_DB_MAX_ENTRIES = int(os.getenv("ECHO_LLM_CACHE_DB_SIZE", "20000"))
+
+def cache_key(model_name, prompt, **params):
+    blob = json.dumps([model_name, prompt, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """A TTL + LRU cache of response text with an optional SQLite tier."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, db_tier=CACHE_DB_TIER, db_max_entries=CACHE_DB_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_tier = db_tier
+        self.db_max_entries = db_max_entries
+        self._entries = OrderedDict()   # key -> (stored_at, text)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db_hits = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+        if self.db_tier:
+            with connection() as conn:
+                row = conn.execute(
+                    "SELECT response, created_at FROM llm_cache WHERE key = ? AND created_at >= ?",
+                    (key, now - self.ttl),
+                ).fetchone()
+            if row:
+                self._put_memory(key, row[0], row[1])
+                with self._lock:
+                    self.hits += 1
+                    self.db_hits += 1
+                return row[0]
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _put_memory(self, key, text, stored_at):
+        with self._lock:
+            self._entries[key] = (stored_at, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key, text):
+        now = time.time()
+        self._put_memory(key, text, now)
+        if self.db_tier:
+            with connection() as conn:
+                conn.execute("INSERT OR REPLACE INTO llm_cache (key, response, created_at) VALUES (?, ?, ?)", (key, text, now))
+                # Expire old rows and keep the table bounded.
+                conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE created_at < (SELECT created_at FROM llm_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?)",
+                    (self.db_max_entries,),
+                )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.db_tier:
+            with connection() as conn:
+                conn.execute("DELETE FROM llm_cache")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "db_hits": self.db_hits,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+class CachingProvider:
+    """
+    Wraps a provider so identical requests are served from a ResponseCache.
+    Pass cache=False (e.g. for private-scope conversations) to bypass it
+    entirely: nothing is read from or written to the cache. A cache of None
+    disables caching for every call. With validate, a response is only
+    cached if validate(text) is true, so a malformed one isn't replayed.
+    """
+
+    def __init__(self, provider, cache):
+        self.provider = provider
+        self.cache = cache
+        self.model_name = provider.model_name
+
+    def _key(self, prompt, temperature, system):
+        if temperature is None:
+            temperature = getattr(self.provider, "temperature", None)
+        if system is None:
+            return cache_key(self.model_name, prompt, temperature=temperature)
+        return cache_key(self.model_name, prompt, temperature=temperature, system=system)
+
+    @traced("llm.generate")
+    def generate(self, prompt, temperature=None, cache=True, system=None, validate=None):
+        if not cache or self.cache is None:
+            return self.provider.generate(prompt, temperature=temperature, system=system)
+        key = self._key(prompt, temperature, system)
+        text = self.cache.get(key)
+        if text is None:
+            text = self.provider.generate(prompt, temperature=temperature, system=system)
+            if validate is None or validate(text):
+                self.cache.put(key, text)
+        return text
+
+    def stream(self, prompt, temperature=None, cache=True, system=None, validate=None):
+        if not cache or self.cache is None:
+            yield from self.provider.stream(prompt, temperature=temperature, system=system)
+            return
+        key = self._key(prompt, temperature, system)
+        text = self.cache.get(key)
+        if text is not None:
+            yield text
+            return
+        chunks = []
+        for chunk in self.provider.stream(prompt, temperature=temperature, system=system):
+            chunks.append(chunk)
+            yield chunk
+        # Only a stream that ran to completion (and validates) is cached.
+        text = "".join(chunks)
+        if validate is None or validate(text):
+            self.cache.put(key, text)
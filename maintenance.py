@@ -0,0 +1,206 @@
+"""
+Routine upkeep for echo.db.
+
+    python maintenance.py                 # one pass, then print what it reclaimed
+    python maintenance.py --full-vacuum   # one-off: switch an old DB to incremental auto-vacuum
+
+In the app the same pass runs as a background job every
+ECHO_MAINTENANCE_INTERVAL seconds (see schedule()), over the directory DB and
+every shard when sharding is on. Each pass:
+
+1. purges junk rows: memories set to null (e.g. a reset secret keyword),
+   leftover convo_meta_* rows, expired sessions, stale LLM cache entries and
+   reply leases left behind by a crashed process;
+2. hands free pages back to the filesystem with PRAGMA incremental_vacuum;
+3. refreshes planner statistics (ANALYZE / PRAGMA optimize);
+4. checkpoints and truncates the WAL.
+
+Deletes and vacuum steps are done in small transactions, each kept under
+STEP_SECONDS of work, so the app's writers are never blocked for long, and
+the whole pass stops when its time budget runs out.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+import memory
+from llm_cache import CACHE_TTL_SECONDS
+
+INTERVAL_SECONDS = float(os.getenv("ECHO_MAINTENANCE_INTERVAL", str(6 * 3600)))   # 0 disables the schedule
+RUN_BUDGET_SECONDS = float(os.getenv("ECHO_MAINTENANCE_BUDGET", "30"))
+STEP_SECONDS = 0.05        # target length of a single write transaction
+PURGE_CHUNK = 500          # starting rows per delete; adapts to STEP_SECONDS
+VACUUM_PAGES = 256         # starting pages per incremental_vacuum; adapts likewise
+ANALYSIS_LIMIT = 400       # rows ANALYZE samples per index
+
+# Junk rows: (label, table, key column, WHERE clause, params factory).
+PURGES = (
+    ("null_memories", "memories", "id", "value = 'null'", lambda: ()),
+    ("convo_meta", "memories", "id", "scope = 'meta' AND key LIKE 'convo_meta_%'", lambda: ()),
+    ("expired_sessions", "sessions", "token_hash", "expires_at < ?", lambda: (time.time(),)),
+    ("stale_llm_cache", "llm_cache", "key", "created_at < ?", lambda: (time.time() - CACHE_TTL_SECONDS,)),
+    ("expired_reply_leases", "reply_leases", "conversation_id", "expires_at < ?", lambda: (time.time(),)),
+)
+
+def _file_bytes(db_file):
+    total = 0
+    for path in (db_file, f"{db_file}-wal"):
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+def _next_size(size, elapsed, floor=1):
+    """Grow or shrink a batch so the next transaction takes about STEP_SECONDS."""
+    if elapsed > STEP_SECONDS:
+        return max(floor, size // 2)
+    if elapsed < STEP_SECONDS / 4:
+        return size * 2
+    return size
+
+def purge_junk(db_file, deadline):
+    """Delete junk rows in short transactions. Returns {label: rows deleted}."""
+    deleted = {}
+    for label, table, key, where, params in PURGES:
+        chunk, total = PURGE_CHUNK, 0
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            with memory.connection(db_file) as conn:
+                cursor = conn.execute(
+                    f"DELETE FROM {table} WHERE {key} IN (SELECT {key} FROM {table} WHERE {where} LIMIT ?)",
+                    (*params(), chunk),
+                )
+            total += cursor.rowcount
+            if cursor.rowcount < chunk:
+                break
+            chunk = _next_size(chunk, time.perf_counter() - start)
+        deleted[label] = total
+    return deleted
+
+def incremental_vacuum(db_file, deadline):
+    """Release free pages a batch at a time. Returns pages freed, or None if the DB isn't in incremental mode."""
+    with memory.connection(db_file) as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return None
+    pages, freed = VACUUM_PAGES, 0
+    while time.monotonic() < deadline:
+        with memory.connection(db_file) as conn:
+            free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free_before:
+                break
+            start = time.perf_counter()
+            # Each step of the pragma frees a page, so it has to be run to completion.
+            conn.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+            elapsed = time.perf_counter() - start
+            freed += free_before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        pages = _next_size(pages, elapsed)
+    return freed
+
+def refresh_statistics(db_file):
+    """Full ANALYZE the first time, after that only tables whose stats have drifted."""
+    with memory.connection(db_file) as conn:
+        conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+        has_stats = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+        # 0x10002: consider every table, not just those this connection has queried.
+        conn.execute("PRAGMA optimize=0x10002" if has_stats else "ANALYZE")
+        conn.execute("PRAGMA analysis_limit=0")
+    return "optimize" if has_stats else "analyze"
+
+def checkpoint(db_file):
+    """Checkpoint the WAL and truncate it to zero bytes. Returns True if readers kept it from finishing."""
+    with memory.connection(db_file) as conn:
+        busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    return bool(busy)
+
+def run_maintenance(db_file=None, budget=RUN_BUDGET_SECONDS):
+    """One maintenance pass. Returns a report of what each step did and how long it took."""
+    db_file = db_file or memory.DB_FILE
+    started = time.perf_counter()
+    deadline = time.monotonic() + budget
+    size_before = _file_bytes(db_file)
+    report = {}
+    steps = (
+        ("purge", lambda: purge_junk(db_file, deadline)),
+        ("vacuum_pages", lambda: incremental_vacuum(db_file, deadline)),
+        ("statistics", lambda: refresh_statistics(db_file)),
+        ("checkpoint", lambda: checkpoint(db_file)),
+    )
+    for name, step in steps:
+        if time.monotonic() >= deadline:
+            report[name] = "skipped (out of time)"
+            continue
+        step_start = time.perf_counter()
+        try:
+            report[name] = step()
+        except sqlite3.OperationalError as e:
+            # Most likely "database is locked"; the next pass will catch up.
+            report[name] = f"error: {e}"
+        report[f"{name}_seconds"] = round(time.perf_counter() - step_start, 3)
+    report["reclaimed_bytes"] = size_before - _file_bytes(db_file)
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    return report
+
+def format_report(report):
+    purged = report.get("purge")
+    if isinstance(purged, dict):
+        purged = ", ".join(f"{n} {label}" for label, n in purged.items() if n) or "nothing"
+    vacuumed = report.get("vacuum_pages")
+    if vacuumed is None:
+        vacuumed = "nothing (incremental vacuum not enabled; run with --full-vacuum once)"
+    elif isinstance(vacuumed, int):
+        vacuumed = f"{vacuumed} pages"
+    wal = report.get("checkpoint")
+    if isinstance(wal, bool):
+        wal = "busy, retry later" if wal else "truncated"
+    return (
+        f"--- Maintenance: reclaimed {report['reclaimed_bytes'] / 1024:,.0f} KB in {report['seconds']:.2f}s; "
+        f"purged {purged}; vacuumed {vacuumed}; statistics: {report.get('statistics')}; WAL: {wal}"
+    )
+
+def enable_incremental_vacuum(db_file=None):
+    """
+    Switch an existing database to auto_vacuum=INCREMENTAL. This needs a full
+    VACUUM, which holds the write lock throughout, so run it while the app is down.
+    New databases are created in incremental mode already.
+    """
+    db_file = db_file or memory.DB_FILE
+    with memory.connection(db_file) as conn:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+_scheduled = False
+
+def schedule(interval=INTERVAL_SECONDS):
+    """Queue the periodic maintenance job if it isn't already (safe to call on every rerun)."""
+    global _scheduled
+    from jobs import enqueue_once
+
+    if interval > 0 and not _scheduled:
+        enqueue_once("maintenance", {}, delay=interval)
+        _scheduled = True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vacuum, analyze, checkpoint and purge junk rows in echo.db.")
+    parser.add_argument("--db", help=f"database file (default: {memory.DB_FILE})")
+    parser.add_argument("--budget", type=float, default=RUN_BUDGET_SECONDS, help="seconds the pass may take")
+    parser.add_argument("--full-vacuum", action="store_true", help="enable incremental auto-vacuum with a one-off full VACUUM first")
+    args = parser.parse_args(argv)
+    if args.db:
+        memory.DB_FILE = args.db
+    memory.init_db()
+    if args.full_vacuum:
+        before = sum(_file_bytes(f) for f in memory.all_db_files())
+        start = time.perf_counter()
+        for db_file in memory.all_db_files():
+            enable_incremental_vacuum(db_file)
+        print(f"--- Full VACUUM: {(before - sum(_file_bytes(f) for f in memory.all_db_files())) / 1024:,.0f} KB reclaimed in {time.perf_counter() - start:.2f}s")
+    for db_file in memory.all_db_files():
+        print(format_report(run_maintenance(db_file, budget=args.budget)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
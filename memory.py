@@ -1,20 +1,189 @@
 import sqlite3
 import json
+import os
+import queue
+import threading
+import time
+import hashlib
+import lzma
+import zlib
+import hmac
+import secrets
+import functools
+import inspect
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, timedelta
 import bcrypt
+from tracing import instrument
 
 DB_FILE = "echo.db"
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
+# Optional sharding (see the SHARDING section): with ECHO_SHARD_DIR set,
+# DB_FILE becomes that directory's directory.db and each user's conversations
+# live in a shard file next to it.
+SHARD_DIR = os.getenv("ECHO_SHARD_DIR")
+SHARD_COUNT = int(os.getenv("ECHO_SHARD_COUNT", "0"))   # 0 = one file per user
+if SHARD_DIR:
+    DB_FILE = os.path.join(SHARD_DIR, "directory.db")
+
+# --- CONNECTION POOL ---
+# Streamlit runs every rerun on its own script thread, so a connection per call
+# (or per thread) means paying connect + pragma setup dozens of times a rerun.
+# Instead each database file gets a small bounded pool of long-lived connections.
+POOL_SIZE = int(os.getenv("ECHO_DB_POOL_SIZE", "8"))
+BUSY_TIMEOUT_MS = int(os.getenv("ECHO_DB_BUSY_TIMEOUT_MS", "5000"))
+PRAGMAS = (
+    # Only takes effect on a new (empty) file; see maintenance.py for existing ones.
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+class ConnectionPool:
+    """A bounded pool of SQLite connections to a single database file."""
+
+    def __init__(self, db_file, size=POOL_SIZE):
+        self.db_file = db_file
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_file, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._open()
+                except Exception:
+                    self._created -= 1
+                    raise
+        # Pool is exhausted: wait for another thread to hand a connection back.
+        try:
+            return self._idle.get(timeout=BUSY_TIMEOUT_MS / 1000)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"connection pool for {self.db_file} exhausted")
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+_pools = {}
+_pools_lock = threading.Lock()
+_local = threading.local()
+
+def get_pool(db_file=None):
+    db_file = db_file or DB_FILE
+    with _pools_lock:
+        pool = _pools.get(db_file)
+        if pool is None:
+            pool = _pools[db_file] = ConnectionPool(db_file)
+        return pool
+
+@contextmanager
+def connection(db_file=None):
+    """
+    Borrow a pooled connection for the duration of a `with` block.
+    The block commits on success and rolls back on error. Nested blocks on the
+    same thread reuse the outer connection, and only the outermost one commits.
+    """
+    db_file = db_file or DB_FILE
+    held = getattr(_local, "held", None)
+    if held is None:
+        held = _local.held = {}
+    if db_file in held:
+        conn, depth = held[db_file]
+        held[db_file] = (conn, depth + 1)
+        try:
+            yield conn
+        finally:
+            held[db_file] = (conn, depth)
+        return
+
+    pool = get_pool(db_file)
+    conn = pool.acquire()
+    held[db_file] = (conn, 1)
+    pending = _local.__dict__.setdefault("on_commit", {})
+    try:
+        with conn:
+            yield conn
+    finally:
+        del held[db_file]
+        pool.release(conn)
+        callbacks = pending.pop(db_file, ())
+    for callback in callbacks:
+        callback()
+
+@contextmanager
+def transaction(db_file=None):
+    """
+    A unit of work: every memory.py call made inside the block on this thread
+    (for the same file) joins one transaction that commits once at the end, or
+    not at all if the block raises. The write lock is taken up front, so reads
+    in the block see the state the writes apply to.
+    """
+    with connection(db_file) as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        yield conn
+
+def on_commit(callback, db_file=None):
+    """Call callback once this thread's open transaction on db_file commits (right away if none is open)."""
+    db_file = db_file or DB_FILE
+    if db_file in getattr(_local, "held", {}):
+        _local.on_commit.setdefault(db_file, []).append(callback)
+    else:
+        callback()
+
+def close_connections():
+    """Close every idle pooled connection (used by tooling and before deleting a DB file)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+# --- SCHEMA MIGRATIONS ---
+# Each migration upgrades the schema by one step. PRAGMA user_version records
+# how many have been applied, so existing echo.db files are upgraded in place.
+
+def _migrate_base_schema(conn):
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS memories (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -25,7 +194,7 @@ def init_db():
             UNIQUE(user_id, scope, key)
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS conversations (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -35,7 +204,7 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             conversation_id INTEGER NOT NULL,
@@ -46,139 +215,1311 @@ def init_db():
             FOREIGN KEY (conversation_id) REFERENCES conversations (id)
         )
     ''')
-    conn.commit()
-    conn.close()
+
+def _migrate_cascade_and_indexes(conn):
+    # SQLite can't alter a foreign key in place, so rebuild the child tables
+    # with ON DELETE CASCADE. Rows whose parent is already gone are dropped.
+    conn.execute('''
+        CREATE TABLE memories_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE(user_id, scope, key)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO memories_new (id, user_id, scope, key, value)
+        SELECT id, user_id, scope, key, value FROM memories
+        WHERE user_id IN (SELECT id FROM users)
+    ''')
+    conn.execute('''
+        CREATE TABLE conversations_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            scope TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO conversations_new (id, user_id, title, scope, created_at)
+        SELECT id, user_id, title, scope, created_at FROM conversations
+        WHERE user_id IN (SELECT id FROM users)
+    ''')
+    conn.execute('''
+        CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            avatar TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO messages_new (id, conversation_id, role, content, avatar, timestamp)
+        SELECT id, conversation_id, role, content, avatar, timestamp FROM messages
+        WHERE conversation_id IN (SELECT id FROM conversations_new)
+    ''')
+    for table in ("memories", "conversations", "messages"):
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    # get_messages / clear_conversation / cascade deletes
+    conn.execute("CREATE INDEX idx_messages_conversation ON messages (conversation_id, timestamp)")
+    # get_conversations: covers the filter, the sort and the selected columns
+    conn.execute("CREATE INDEX idx_conversations_user_scope ON conversations (user_id, scope, created_at, title)")
+
+def _migrate_conversation_meta(conn):
+    # Pinned / archived / renamed used to live in memories as one JSON blob per
+    # conversation under scope "meta", which cost the sidebar two lookups per chat.
+    conn.execute("ALTER TABLE conversations ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE conversations ADD COLUMN archived INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE conversations ADD COLUMN title_override TEXT")
+    rows = conn.execute(
+        "SELECT user_id, key, value FROM memories WHERE scope = 'meta' AND key LIKE 'convo_meta_%'"
+    ).fetchall()
+    for user_id, key, value in rows:
+        try:
+            meta = json.loads(value)
+            if isinstance(meta, str):
+                meta = json.loads(meta)
+            convo_id = int(key[len("convo_meta_"):])
+        except (ValueError, TypeError):
+            continue
+        if not isinstance(meta, dict):
+            continue  # the null rows Delete used to leave behind
+        conn.execute(
+            "UPDATE conversations SET pinned = ?, archived = ?, title_override = ? WHERE id = ? AND user_id = ?",
+            (int(bool(meta.get("pinned"))), int(bool(meta.get("archived"))), meta.get("title") or None, convo_id, user_id),
+        )
+    conn.execute("DELETE FROM memories WHERE scope = 'meta' AND key LIKE 'convo_meta_%'")
+    conn.execute('''
+        CREATE INDEX idx_conversations_sidebar
+        ON conversations (user_id, scope, archived, pinned DESC, created_at DESC, title, title_override)
+    ''')
+
+def _migrate_message_id_index(conn):
+    # Messages are paged by id (keyset pagination), and id is also the true
+    # insertion order where second-resolution timestamps tie, so the
+    # (conversation_id, timestamp) index is replaced rather than kept alongside.
+    conn.execute("DROP INDEX IF EXISTS idx_messages_conversation")
+    conn.execute("CREATE INDEX idx_messages_conversation_id ON messages (conversation_id, id)")
+
+def _migrate_jobs_table(conn):
+    # Deferred work (see jobs.py). Rows outlive the process, so anything still
+    # pending or mid-run when the server stops is picked up again on restart.
+    conn.execute('''
+        CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL,
+            claimed_at REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_jobs_status_run_after ON jobs (status, run_after)")
+
+def _migrate_llm_cache_table(conn):
+    # Optional persistent tier of the LLM response cache (see llm_cache.py).
+    conn.execute('''
+        CREATE TABLE llm_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX idx_llm_cache_created_at ON llm_cache (created_at)")
+
+def _migrate_user_facts(conn):
+    # One row per remembered fact / strength instead of a JSON list per scope
+    # in memories, so items accumulate, dedupe and can be ranked and capped.
+    conn.execute('''
+        CREATE TABLE user_facts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            scope TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            text TEXT NOT NULL,
+            norm_key TEXT NOT NULL,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 1,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE(user_id, scope, kind, norm_key)
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_user_facts_rank ON user_facts (user_id, scope, kind, hits DESC, last_seen DESC)")
+    rows = conn.execute("SELECT user_id, scope, key, value FROM memories WHERE key IN ('facts', 'strengths')").fetchall()
+    for user_id, scope, key, value in rows:
+        try:
+            items = json.loads(value)
+        except ValueError:
+            continue
+        if isinstance(items, list):
+            _reinforce(conn, user_id, scope, key[:-1], items)
+    conn.execute("DELETE FROM memories WHERE key IN ('facts', 'strengths')")
+
+def _migrate_conversation_summaries(conn):
+    # Rolling summary of the older part of each conversation (context_builder.py).
+    # through_message_id is the last message folded in, so updates only ever
+    # read messages after it.
+    conn.execute('''
+        CREATE TABLE conversation_summaries (
+            conversation_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            through_message_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        )
+    ''')
+
+# Full-text index over message content. `owner` holds one token per
+# (user, scope), e.g. "u12public", so a search is an intersection of posting
+# lists inside FTS rather than a post-filter over every match in the DB.
+_FTS_INSERT_SQL = """
+    INSERT INTO messages_fts (rowid, content, owner)
+    SELECT m.id, m.content, 'u' || c.user_id || c.scope
+    FROM messages m JOIN conversations c ON c.id = m.conversation_id
+"""
+
+def _migrate_message_search(conn):
+    conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(content, owner, tokenize = 'unicode61 remove_diacritics 2')")
+    conn.execute('''
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content, owner)
+            SELECT new.id, new.content, 'u' || c.user_id || c.scope
+            FROM conversations c WHERE c.id = new.conversation_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            UPDATE messages_fts SET content = new.content WHERE rowid = new.id;
+        END
+    ''')
+    conn.execute(_FTS_INSERT_SQL)
+
+def _migrate_sessions(conn):
+    # Login sessions that survive a browser refresh (see create_session).
+    # Only a hash of each token is stored. `settings` holds the signing key.
+    conn.execute('''
+        CREATE TABLE sessions (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX idx_sessions_user ON sessions (user_id)")
+    conn.execute('''
+        CREATE TABLE settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+def _migrate_legacy_import_progress(conn):
+    # Per-user checkpoints for import_legacy.py, so imports are resumable and idempotent.
+    conn.execute('''
+        CREATE TABLE legacy_import_progress (
+            source TEXT NOT NULL,
+            username TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            conversation_ids TEXT NOT NULL DEFAULT '[]',
+            created_user INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (source, username),
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    ''')
+
+def _migrate_conversation_archives(conn):
+    # Cold tier for archived conversations: all of a conversation's messages
+    # packed into one compressed blob (see archive_messages).
+    conn.execute('''
+        CREATE TABLE conversation_archives (
+            conversation_id INTEGER PRIMARY KEY,
+            codec TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            message_count INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            packed_bytes INTEGER NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        )
+    ''')
+
+def _migrate_shard_directory(conn):
+    # Only populated in the directory DB of a sharded install: which shard
+    # holds each user, and the conversation id allocator (conversation ids
+    # stay unique across shards so they can route on their own).
+    conn.execute('''
+        CREATE TABLE user_shards (
+            user_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE conversation_shards (
+            conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute("CREATE INDEX idx_conversation_shards_user ON conversation_shards (user_id)")
+
+def _migrate_mood_history(conn):
+    # The model's sentiment for each user message, plus running per-day and
+    # per-week tallies of it (see MOOD HISTORY), so mood trends never scan messages.
+    conn.execute("ALTER TABLE messages ADD COLUMN sentiment TEXT")
+    for table in ("mood_daily", "mood_weekly"):
+        conn.execute(f'''
+            CREATE TABLE {table} (
+                user_id INTEGER NOT NULL,
+                scope TEXT NOT NULL,
+                period TEXT NOT NULL,
+                positive INTEGER NOT NULL DEFAULT 0,
+                neutral INTEGER NOT NULL DEFAULT 0,
+                negative INTEGER NOT NULL DEFAULT 0,
+                other INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, scope, period),
+                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+        ''')
+
+def _migrate_reply_leases(conn):
+    # Who is generating the reply to a conversation's latest message (see REPLY LEASES).
+    conn.execute('''
+        CREATE TABLE reply_leases (
+            conversation_id INTEGER PRIMARY KEY,
+            message_id INTEGER NOT NULL,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        )
+    ''')
+
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_cascade_and_indexes,
+    _migrate_conversation_meta,
+    _migrate_message_id_index,
+    _migrate_jobs_table,
+    _migrate_llm_cache_table,
+    _migrate_user_facts,
+    _migrate_conversation_summaries,
+    _migrate_message_search,
+    _migrate_sessions,
+    _migrate_legacy_import_progress,
+    _migrate_conversation_archives,
+    _migrate_shard_directory,
+    _migrate_mood_history,
+    _migrate_reply_leases,
+]
+
+_initialized = set()
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(db_file=None):
+    """Apply any pending migrations to db_file and return the resulting schema version."""
+    with connection(db_file) as conn:
+        # Table rebuilds need foreign key enforcement off, and the pragma is a
+        # no-op inside a transaction, so toggle it around the whole run.
+        conn.execute("PRAGMA foreign_keys=OFF")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            version = schema_version(conn)
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return version
+            # All pending steps run in one transaction so a failure leaves the
+            # file exactly as it was.
+            for step in range(version, len(MIGRATIONS)):
+                MIGRATIONS[step](conn)
+            if conn.execute("PRAGMA foreign_key_check").fetchone():
+                raise sqlite3.IntegrityError("migration left dangling foreign keys")
+            conn.execute(f"PRAGMA user_version={len(MIGRATIONS)}")
+            conn.commit()
+            return len(MIGRATIONS)
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.execute("PRAGMA foreign_keys=ON")
+
+def init_db():
+    db_file = DB_FILE
+    if db_file in _initialized:
+        return
+    if SHARD_DIR:
+        os.makedirs(SHARD_DIR, exist_ok=True)
+    migrate(db_file)
+    _initialized.add(db_file)
+
+# --- SHARDING ---
+# Everything about a user's conversations (conversations, messages, memories,
+# facts, summaries, archives, search) lives in that user's shard file, so
+# writers for different users don't queue on one SQLite write lock. The
+# directory DB keeps accounts, sessions, jobs and the routing tables.
+#
+# Shards are numbered from 1: shard n is shard_<n>.db, and is either one user
+# (SHARD_COUNT=0, so deleting a user is a file unlink) or users hashed into
+# SHARD_COUNT buckets. Each shard allocates message ids from n << SHARD_ID_BITS
+# up, so ids stay unique across shards and shard_tool.py can merge them back.
+# With sharding off every router returns None, i.e. DB_FILE.
+SHARD_ID_BITS = 40
+
+_user_shards = {}          # user_id -> shard file
+_conversation_users = {}   # conversation_id -> user_id
+
+def shard_file(shard):
+    return os.path.join(SHARD_DIR, f"shard_{shard:05d}.db")
+
+def shard_for_user(user_id):
+    return user_id if SHARD_COUNT <= 0 else 1 + user_id % SHARD_COUNT
+
+def open_shard(shard):
+    """Migrate shard `shard` (once per process) and return its path."""
+    path = shard_file(shard)
+    if path not in _initialized:
+        migrate(path)
+        with connection(path) as conn:
+            base = shard << SHARD_ID_BITS
+            if not conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'messages'", (base,)).rowcount:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', ?)", (base,))
+        _initialized.add(path)
+    return path
+
+def shard_files():
+    """Every shard file in use (empty when sharding is off)."""
+    if not SHARD_DIR:
+        return []
+    with connection() as conn:
+        shards = [row[0] for row in conn.execute("SELECT DISTINCT shard FROM user_shards ORDER BY shard")]
+    return [open_shard(shard) for shard in shards]
+
+def all_db_files():
+    return [DB_FILE] + shard_files()
+
+def user_db(user_id):
+    """The database file holding user_id's conversations (None means DB_FILE)."""
+    if not SHARD_DIR:
+        return None
+    path = _user_shards.get(user_id)
+    if path is None:
+        with connection() as conn:
+            row = conn.execute("SELECT shard FROM user_shards WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None   # unknown user: reads find nothing in the directory
+        path = _user_shards[user_id] = open_shard(row[0])
+    return path
+
+def conversation_db(conversation_id):
+    """The database file holding conversation_id (None means DB_FILE)."""
+    if not SHARD_DIR:
+        return None
+    user_id = _conversation_users.get(conversation_id)
+    if user_id is None:
+        with connection() as conn:
+            row = conn.execute("SELECT user_id FROM conversation_shards WHERE conversation_id = ?", (conversation_id,)).fetchone()
+        if row is None:
+            return None
+        user_id = _conversation_users[conversation_id] = row[0]
+    return user_db(user_id)
+
+def _assign_shard(user_id, username):
+    """Place a new user on a shard (the shard copy of the users row only satisfies foreign keys)."""
+    shard = shard_for_user(user_id)
+    with connection() as conn:
+        conn.execute("INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)", (user_id, shard))
+    with connection(open_shard(shard)) as conn:
+        conn.execute("INSERT OR IGNORE INTO users (id, username, password_hash) VALUES (?, ?, '')", (user_id, username))
+
+def _allocate_conversation_id(user_id):
+    """A cluster-wide conversation id when sharded; None lets the table assign one."""
+    if not SHARD_DIR:
+        return None
+    with connection() as conn:
+        conversation_id = conn.execute("INSERT INTO conversation_shards (user_id) VALUES (?)", (user_id,)).lastrowid
+    _conversation_users[conversation_id] = user_id
+    return conversation_id
+
+# --- READ CACHE ---
+# Most reruns redraw the same sidebar, titles and messages as the one before,
+# so the reads below are served from an in-process LRU and SQLite is only
+# asked again once something they depend on has changed. Each cached read
+# names the entities it depends on (a conversation's "messages", a user's
+# "conversations" list, ...); each write bumps the version counters of the
+# entities it touches once its transaction commits, and an entry recorded
+# under older versions is a miss.
+#
+# Entries are keyed by every argument of the read, user and scope included, so
+# a public-scope read is never answered from a private-scope entry or another
+# user's. Private-scope entries are also tagged with their owner, and
+# forget_private() drops them when the user leaves private mode or logs out.
+#
+# Versions only exist in this process. Writes from another process on the
+# same database (a second app or API server, export_data.py import, ...)
+# show up after at most READ_CACHE_TTL seconds; set ECHO_READ_CACHE=0 there.
+READ_CACHE_ENABLED = os.getenv("ECHO_READ_CACHE", "1") != "0"
+READ_CACHE_SIZE = int(os.getenv("ECHO_READ_CACHE_SIZE", "2048"))
+READ_CACHE_TTL = float(os.getenv("ECHO_READ_CACHE_TTL", "60"))
+
+class ReadCache:
+    """A bounded LRU of read results, checked against per-entity version counters."""
+
+    def __init__(self, max_entries=READ_CACHE_SIZE, ttl=READ_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (expires_at, entities, versions, owner, value)
+        self._versions = {}             # entity -> number of committed writes to it
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def versions(self, entities):
+        with self._lock:
+            return tuple(self._versions.get(entity, 0) for entity in entities)
+
+    def get(self, key):
+        """(True, value) if key is cached and nothing it depends on has changed since, else (False, None)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, entities, versions, _, value = entry
+                if expires_at > time.monotonic() and versions == tuple(self._versions.get(entity, 0) for entity in entities):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, entities, versions, owner, value):
+        """Store value, read while the entities were at `versions` (taken before the query ran)."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entities, versions, owner, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def bump(self, entities):
+        with self._lock:
+            for entity in entities:
+                self._versions[entity] = self._versions.get(entity, 0) + 1
+
+    def forget(self, owner):
+        """Drop every entry belonging to owner, a (user_id, scope) pair, and every entry whose owner is unknown."""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[3] in (owner, None)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+read_cache = ReadCache()
+
+def _shared_copy(value):
+    # Callers may append to or filter what they get back; the rows inside are shared.
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+def cached_read(depends_on, owner):
+    """
+    Serve the decorated read from read_cache. depends_on(*args) returns the
+    entities the result depends on; owner(result, *args) the (user_id, scope)
+    it belongs to, or None. Both get the call's arguments with defaults filled in.
+    """
+    def decorate(func):
+        parameters = inspect.signature(func).parameters
+        positions = {name: i for i, name in enumerate(parameters)}
+        defaults = tuple(p.default for p in parameters.values())
+
+        @functools.wraps(func)
+        def read(*args, **kwargs):
+            # Inside a unit of work the caller must see its own uncommitted writes.
+            if not READ_CACHE_ENABLED or getattr(_local, "held", None):
+                return func(*args, **kwargs)
+            if not kwargs.keys() <= positions.keys():
+                return func(*args, **kwargs)   # let it raise the TypeError
+            arguments = args + defaults[len(args):]
+            if kwargs:
+                arguments = list(arguments)
+                for name, value in kwargs.items():
+                    arguments[positions[name]] = value
+                arguments = tuple(arguments)
+            key = (func.__name__, *arguments)
+            hit, value = read_cache.get(key)
+            if hit:
+                return _shared_copy(value)
+            entities = depends_on(*arguments)
+            versions = read_cache.versions(entities)
+            value = func(*args, **kwargs)
+            read_cache.put(key, entities, versions, owner(value, *arguments), value)
+            return _shared_copy(value)
+        return read
+    return decorate
+
+def _invalidate(db_file, *entities):
+    """Bump entities once this thread's transaction on db_file commits (right away if none is open)."""
+    if READ_CACHE_ENABLED:
+        on_commit(lambda: read_cache.bump(entities), db_file)
+
+def forget_private(user_id):
+    """Drop user_id's cached private-scope reads (on leaving private mode and on logout)."""
+    read_cache.forget((user_id, "private"))
+
+# Owners of the conversations seen so far, learned from list reads for free, so
+# tagging a conversation's entries never costs a query. An entry of a
+# conversation not seen yet is tagged None and forget_private() drops it too.
+_conversation_owners = {}   # conversation_id -> (user_id, scope)
+
+def _owned_by_user(result, user_id, scope, *_):
+    return (user_id, scope)
+
+def _owned_by_conversation(result, conversation_id, *_):
+    return _conversation_owners.get(conversation_id)
+
+def _owner_of_listed(result, user_id, scope):
+    for row in result:
+        _conversation_owners[row["id"] if isinstance(row, dict) else row[0]] = (user_id, scope)
+    return (user_id, scope)
+
+def _owner_of_row(convo, conversation_id):
+    if convo is None:
+        return None
+    _conversation_owners[conversation_id] = owner = (convo["user_id"], convo["scope"])
+    return owner
+
+# --- PASSWORDS ---
+# bcrypt is deliberately slow, so it runs on a small bounded pool: a burst of
+# logins queues there instead of occupying every Streamlit script thread.
+BCRYPT_ROUNDS = int(os.getenv("ECHO_BCRYPT_ROUNDS", "12"))
+AUTH_WORKERS = int(os.getenv("ECHO_AUTH_WORKERS", "2"))
+_auth_executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="echo-auth")
+
+def hash_password(password):
+    """bcrypt hash of password at BCRYPT_ROUNDS (computed on the auth pool)."""
+    future = _auth_executor.submit(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS))
+    return future.result().decode('utf-8')
+
+# Stored for accounts that must not be able to log in yet (e.g. imported
+# without a password). bcrypt never produces it, so nothing matches it.
+UNUSABLE_PASSWORD_HASH = "!"
+
+def _verify_password(password, password_hash):
+    if not password_hash.startswith("$2"):
+        return False
+    future = _auth_executor.submit(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+    return future.result()
+
+def _hash_rounds(password_hash):
+    try:
+        return int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
 
 def add_user(username, password):
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    password_hash = hash_password(password)
     try:
-        cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash.decode('utf-8')))
-        conn.commit()
-        return True
+        with connection() as conn:
+            user_id = conn.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash)).lastrowid
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
+    if SHARD_DIR:
+        _assign_shard(user_id, username)
+    return True
 
 def check_user(username, password):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    conn.close()
-    if user and bcrypt.checkpw(password.encode('utf-8'), user[1].encode('utf-8')):
+    with connection() as conn:
+        user = conn.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,)).fetchone()
+    if user and _verify_password(password, user[1]):
+        if _hash_rounds(user[1]) != BCRYPT_ROUNDS:
+            # The cost factor changed since this hash was made; we have the
+            # plaintext now, so upgrade it transparently.
+            with connection() as conn:
+                conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (hash_password(password), user[0]))
         return user[0]
     return None
 
+# --- SESSIONS ---
+# A session token is "<id>.<expires_at>.<signature>". The HMAC signature lets
+# forged or expired tokens be rejected without touching the database; the
+# sessions table (keyed by a hash of the id) makes tokens revocable.
+SESSION_TTL_SECONDS = int(os.getenv("ECHO_SESSION_TTL", str(14 * 24 * 3600)))
+
+_session_secrets = {}
+
+def _session_secret():
+    secret = os.getenv("ECHO_SESSION_SECRET")
+    if secret:
+        return secret.encode('utf-8')
+    if DB_FILE not in _session_secrets:
+        with connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('session_secret', ?)", (secrets.token_hex(32),))
+            value = conn.execute("SELECT value FROM settings WHERE key = 'session_secret'").fetchone()[0]
+        _session_secrets[DB_FILE] = value.encode('utf-8')
+    return _session_secrets[DB_FILE]
+
+def _sign(payload):
+    return hmac.new(_session_secret(), payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def create_session(user_id, ttl=SESSION_TTL_SECONDS):
+    """Start a session for user_id and return its token."""
+    session_id = secrets.token_urlsafe(24)
+    now = time.time()
+    expires_at = int(now + ttl)
+    with connection() as conn:
+        conn.execute(
+            "INSERT INTO sessions (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+            (hashlib.sha256(session_id.encode('utf-8')).hexdigest(), user_id, now, expires_at),
+        )
+    payload = f"{session_id}.{expires_at}"
+    return f"{payload}.{_sign(payload)}"
+
+_RESUME_SESSION_SQL = """
+    SELECT u.id, u.username FROM sessions s JOIN users u ON u.id = s.user_id
+    WHERE s.token_hash = ? AND s.expires_at >= ?
+"""
+
+def resume_session(token):
+    """Return (user_id, username) for a valid, unexpired token, else None. No bcrypt involved."""
+    try:
+        session_id, expires_at, signature = token.split(".")
+        expired = int(expires_at) < time.time()
+    except (AttributeError, ValueError):
+        return None
+    if expired or not hmac.compare_digest(signature, _sign(f"{session_id}.{expires_at}")):
+        return None
+    with connection() as conn:
+        row = conn.execute(_RESUME_SESSION_SQL, (hashlib.sha256(session_id.encode('utf-8')).hexdigest(), time.time())).fetchone()
+    return (row[0], row[1]) if row else None
+
+def end_session(token):
+    try:
+        session_id = token.split(".")[0]
+    except AttributeError:
+        return
+    with connection() as conn:
+        conn.execute("DELETE FROM sessions WHERE token_hash = ?", (hashlib.sha256(session_id.encode('utf-8')).hexdigest(),))
+
 def remember(user_id, scope, key, value):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO memories (user_id, scope, key, value) VALUES (?, ?, ?, ?)", (user_id, scope, key, json.dumps(value)))
-    conn.commit()
-    conn.close()
+    with connection(user_db(user_id)) as conn:
+        conn.execute("INSERT OR REPLACE INTO memories (user_id, scope, key, value) VALUES (?, ?, ?, ?)", (user_id, scope, key, json.dumps(value)))
+    _invalidate(user_db(user_id), ("memories", user_id, scope))
 
+_RECALL_SQL = "SELECT value FROM memories WHERE user_id = ? AND scope = ? AND key = ?"
+
+@cached_read(lambda user_id, scope, key: [("memories", user_id, scope)], _owned_by_user)
 def recall(user_id, scope, key):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM memories WHERE user_id = ? AND scope = ? AND key = ?", (user_id, scope, key))
-    result = cursor.fetchone()
-    conn.close()
+    with connection(user_db(user_id)) as conn:
+        result = conn.execute(_RECALL_SQL, (user_id, scope, key)).fetchone()
     if result:
         return json.loads(result[0])
     return None
 
 def create_conversation(user_id, title, scope):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO conversations (user_id, title, scope) VALUES (?, ?, ?)", (user_id, title, scope))
-    new_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return new_id
+    conversation_id = _allocate_conversation_id(user_id)
+    with connection(user_db(user_id)) as conn:
+        conversation_id = conn.execute("INSERT INTO conversations (id, user_id, title, scope) VALUES (?, ?, ?, ?)", (conversation_id, user_id, title, scope)).lastrowid
+    _conversation_owners[conversation_id] = (user_id, scope)
+    # The new id may have been looked up (and found missing) before.
+    _invalidate(user_db(user_id), ("conversations", user_id), ("conversation", conversation_id), ("messages", conversation_id))
+    return conversation_id
+
+_CONVERSATIONS_SQL = "SELECT id, title FROM conversations WHERE user_id = ? AND scope = ? ORDER BY created_at DESC"
 
+@cached_read(lambda user_id, scope: [("conversations", user_id)], _owner_of_listed)
 def get_conversations(user_id, scope):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, title FROM conversations WHERE user_id = ? AND scope = ? ORDER BY created_at DESC", (user_id, scope))
-    conversations = cursor.fetchall()
-    conn.close()
-    return conversations
+    with connection(user_db(user_id)) as conn:
+        return conn.execute(_CONVERSATIONS_SQL, (user_id, scope)).fetchall()
 
 def add_message(conversation_id, role, content, avatar):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO messages (conversation_id, role, content, avatar) VALUES (?, ?, ?, ?)", (conversation_id, role, content, avatar))
-    conn.commit()
-    conn.close()
+    with connection(conversation_db(conversation_id)) as conn:
+        # An archived chat's history comes back first, so it isn't hidden behind the new row.
+        _rehydrate(conn, conversation_id)
+        message_id = conn.execute("INSERT INTO messages (conversation_id, role, content, avatar) VALUES (?, ?, ?, ?)", (conversation_id, role, content, avatar)).lastrowid
+    _invalidate(conversation_db(conversation_id), ("messages", conversation_id))
+    return message_id
+
+def _message_dict(row):
+    return {"id": row[0], "role": row[1], "content": row[2], "avatar": row[3], "timestamp": row[4]}
 
+_MESSAGES_SQL = """
+    SELECT id, role, content, avatar, timestamp
+    FROM messages
+    WHERE conversation_id = ?
+    ORDER BY id ASC
+"""
+_MESSAGES_AFTER_SQL = """
+    SELECT id, role, content, avatar, timestamp
+    FROM messages
+    WHERE conversation_id = ? AND id > ?
+    ORDER BY id ASC
+    LIMIT ?
+"""
+_MESSAGES_BEFORE_SQL = """
+    SELECT id, role, content, avatar, timestamp
+    FROM messages
+    WHERE conversation_id = ? AND id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+_COUNT_MESSAGES_SQL = """
+    SELECT (SELECT COUNT(*) FROM messages WHERE conversation_id = ?)
+         + COALESCE((SELECT message_count FROM conversation_archives WHERE conversation_id = ?), 0)
+"""
+
+@cached_read(lambda conversation_id: [("messages", conversation_id)], _owned_by_conversation)
 def get_messages(conversation_id):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT role, content, avatar, timestamp
-        FROM messages
-        WHERE conversation_id = ?
-        ORDER BY timestamp ASC
-    """, (conversation_id,))
-    messages = [
-        {"role": row[0], "content": row[1], "avatar": row[2], "timestamp": row[3]}
-        for row in cursor.fetchall()
-    ]
-    conn.close()
-    return messages
+    with connection(conversation_db(conversation_id)) as conn:
+        _rehydrate(conn, conversation_id)
+        rows = conn.execute(_MESSAGES_SQL, (conversation_id,)).fetchall()
+    return [_message_dict(row) for row in rows]
+
+@cached_read(lambda conversation_id, *_: [("messages", conversation_id)], _owned_by_conversation)
+def get_messages_page(conversation_id, before_id=None, after_id=None, limit=50):
+    """
+    Keyset-paginated messages, always returned oldest-first.
+    - after_id: up to `limit` messages newer than it (limit=None means all of them).
+    - before_id: the `limit` messages just older than it.
+    - neither: the latest `limit` messages.
+    """
+    limit = -1 if limit is None else limit
+    with connection(conversation_db(conversation_id)) as conn:
+        _rehydrate(conn, conversation_id)
+        if after_id is not None:
+            rows = conn.execute(_MESSAGES_AFTER_SQL, (conversation_id, after_id, limit)).fetchall()
+        else:
+            rows = conn.execute(
+                _MESSAGES_BEFORE_SQL, (conversation_id, before_id if before_id is not None else 2**63 - 1, limit)
+            ).fetchall()
+            rows.reverse()
+    return [_message_dict(row) for row in rows]
 
+@cached_read(lambda conversation_id: [("messages", conversation_id)], _owned_by_conversation)
+def count_messages(conversation_id):
+    """Archived messages included (without unpacking them)."""
+    with connection(conversation_db(conversation_id)) as conn:
+        return conn.execute(_COUNT_MESSAGES_SQL, (conversation_id, conversation_id)).fetchone()[0]
+
+@cached_read(lambda conversation_id: [("conversation", conversation_id)], _owner_of_row)
+def get_conversation(conversation_id):
+    """The conversation's owner, scope and display title as a dict, or None if it doesn't exist."""
+    with connection(conversation_db(conversation_id)) as conn:
+        row = conn.execute(
+            "SELECT id, user_id, scope, COALESCE(title_override, title), pinned, archived, created_at FROM conversations WHERE id = ?",
+            (conversation_id,),
+        ).fetchone()
+    if row is None:
+        return None
+    return {
+        "id": row[0], "user_id": row[1], "scope": row[2], "title": row[3],
+        "pinned": bool(row[4]), "archived": bool(row[5]), "created_at": row[6],
+    }
+
+_CONVERSATION_TITLE_SQL = "SELECT title FROM conversations WHERE id = ?"
+
+@cached_read(lambda conversation_id: [("conversation", conversation_id)], _owned_by_conversation)
 def get_conversation_title(conversation_id):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT title FROM conversations WHERE id = ?", (conversation_id,))
-    title = cursor.fetchone()
-    conn.close()
+    with connection(conversation_db(conversation_id)) as conn:
+        title = conn.execute(_CONVERSATION_TITLE_SQL, (conversation_id,)).fetchone()
     return title[0] if title else None
 
 def update_password(user_id, current_password, new_password):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT password_hash FROM users WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
+    with connection() as conn:
+        user = conn.execute("SELECT password_hash FROM users WHERE id = ?", (user_id,)).fetchone()
     
-    if user and bcrypt.checkpw(current_password.encode('utf-8'), user[0].encode('utf-8')):
+    if user and _verify_password(current_password, user[0]):
         # Current password is correct, hash and update the new one
-        new_password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-        cursor.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_password_hash.decode('utf-8'), user_id))
-        conn.commit()
-        conn.close()
+        new_password_hash = hash_password(new_password)
+        with connection() as conn:
+            conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_password_hash, user_id))
         return True
     else:
         # Incorrect current password
-        conn.close()
         return False
 
+_CLEAR_MESSAGES_SQL = "DELETE FROM messages WHERE conversation_id = ?"
+
 def clear_conversation(conversation_id):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
-    conn.commit()
-    conn.close()
+    with connection(conversation_db(conversation_id)) as conn:
+        conn.execute(_CLEAR_MESSAGES_SQL, (conversation_id,))
+        conn.execute("DELETE FROM conversation_archives WHERE conversation_id = ?", (conversation_id,))
+        conn.execute("DELETE FROM conversation_summaries WHERE conversation_id = ?", (conversation_id,))
+    _invalidate(conversation_db(conversation_id), ("messages", conversation_id), ("summary", conversation_id))
 
 # --- ADD THE NEW FUNCTION RIGHT HERE, AT THE END OF THE FILE ---
 
+_DELETE_CONVERSATION_SQL = "DELETE FROM conversations WHERE id = ?"
+
 def delete_conversation(conversation_id):
     """Deletes a conversation and all its messages."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    # First, delete all messages associated with the conversation
-    cursor.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
-    # Then, delete the conversation itself
-    cursor.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
-    conn.commit()
-    conn.close()
+    convo = get_conversation(conversation_id)
+    db_file = conversation_db(conversation_id)
+    with connection(db_file) as conn:
+        # Messages go with it via ON DELETE CASCADE
+        conn.execute(_DELETE_CONVERSATION_SQL, (conversation_id,))
+    _invalidate(
+        db_file, ("conversation", conversation_id), ("messages", conversation_id), ("summary", conversation_id),
+        *([("conversations", convo["user_id"])] if convo else []),
+    )
+    _conversation_owners.pop(conversation_id, None)
+    if SHARD_DIR:
+        with connection() as conn:
+            conn.execute("DELETE FROM conversation_shards WHERE conversation_id = ?", (conversation_id,))
+        _conversation_users.pop(conversation_id, None)
 
 def update_conversation_title(conversation_id, new_title):
     """Updates the title of a specific conversation."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE conversations SET title = ? WHERE id = ?", (new_title, conversation_id))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    convo = get_conversation(conversation_id)
+    with connection(conversation_db(conversation_id)) as conn:
+        conn.execute("UPDATE conversations SET title = ? WHERE id = ?", (new_title, conversation_id))
+    _invalidate(
+        conversation_db(conversation_id), ("conversation", conversation_id),
+        *([("conversations", convo["user_id"])] if convo else []),
+    )
+
+_CONVERSATION_LIST_SQL = """
+    SELECT id, COALESCE(title_override, title), pinned, archived
+    FROM conversations
+    WHERE user_id = ? AND scope = ?
+    ORDER BY archived ASC, pinned DESC, created_at DESC
+"""
+
+@cached_read(lambda user_id, scope: [("conversations", user_id)], _owner_of_listed)
+def get_conversation_list(user_id, scope):
+    """
+    Everything the sidebar needs in one query: pinned chats first, then the
+    rest newest-first, then archived ones. The title is the user's rename if set.
+    """
+    with connection(user_db(user_id)) as conn:
+        rows = conn.execute(_CONVERSATION_LIST_SQL, (user_id, scope)).fetchall()
+    return [
+        {"id": row[0], "title": row[1], "pinned": bool(row[2]), "archived": bool(row[3])}
+        for row in rows
+    ]
+
+def set_conversation_pinned(user_id, conversation_id, pinned):
+    with connection(user_db(user_id)) as conn:
+        conn.execute("UPDATE conversations SET pinned = ? WHERE id = ? AND user_id = ?", (int(bool(pinned)), conversation_id, user_id))
+    _invalidate(user_db(user_id), ("conversations", user_id), ("conversation", conversation_id))
+
+def set_conversation_archived(user_id, conversation_id, archived):
+    """
+    Archiving also moves the messages to cold storage and returns the
+    archive_messages() stats (None if there was nothing to pack); restoring
+    brings them back.
+    """
+    with connection(user_db(user_id)) as conn:
+        cursor = conn.execute("UPDATE conversations SET archived = ? WHERE id = ? AND user_id = ?", (int(bool(archived)), conversation_id, user_id))
+        if not cursor.rowcount:
+            return None
+        _invalidate(user_db(user_id), ("conversations", user_id), ("conversation", conversation_id))
+        if archived:
+            return archive_messages(conversation_id)
+        _rehydrate(conn, conversation_id)
+        return None
+
+def set_conversation_title_override(user_id, conversation_id, title):
+    """Store a user-chosen title; it takes precedence over the auto-generated one."""
+    with connection(user_db(user_id)) as conn:
+        conn.execute("UPDATE conversations SET title_override = ? WHERE id = ? AND user_id = ?", (title or None, conversation_id, user_id))
+    _invalidate(user_db(user_id), ("conversations", user_id), ("conversation", conversation_id))
+
+# --- FACT STORE ---
+# What the Noticing Engine learns about a user ("fact") and their "strength"s.
+# Seeing an item again reinforces it (hits + last_seen); each user keeps at
+# most MAX_FACTS items per scope and kind, evicting the least recently
+# reinforced, and prompts only ever read the top few.
+MAX_FACTS = int(os.getenv("ECHO_MAX_FACTS", "200"))
+FACT_KINDS = ("fact", "strength")
+
+def normalize_fact(text):
+    """The key a fact is deduplicated on: lowercased, whitespace collapsed, edge punctuation stripped."""
+    return " ".join(str(text).lower().split()).strip(" .,!?;:'\"")
+
+def _reinforce(conn, user_id, scope, kind, items):
+    now = time.time()
+    for item in items:
+        text = str(item).strip()
+        key = normalize_fact(text)
+        if not key:
+            continue
+        conn.execute("""
+            INSERT INTO user_facts (user_id, scope, kind, text, norm_key, first_seen, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, scope, kind, norm_key)
+            DO UPDATE SET hits = hits + 1, last_seen = excluded.last_seen, text = excluded.text
+        """, (user_id, scope, kind, text, key, now, now))
+    conn.execute("""
+        DELETE FROM user_facts WHERE id IN (
+            SELECT id FROM user_facts
+            WHERE user_id = ? AND scope = ? AND kind = ?
+            ORDER BY last_seen DESC, id DESC
+            LIMIT -1 OFFSET ?
+        )
+    """, (user_id, scope, kind, MAX_FACTS))
+
+def reinforce_facts(user_id, scope, kind, items):
+    """Record items of `kind` ("fact" or "strength"), bumping ones we've seen before."""
+    if kind not in FACT_KINDS:
+        raise ValueError(f"unknown fact kind {kind!r}")
+    with connection(user_db(user_id)) as conn:
+        _reinforce(conn, user_id, scope, kind, items)
+    _invalidate(user_db(user_id), ("facts", user_id, scope))
+
+_TOP_FACTS_SQL = """
+    SELECT text FROM user_facts
+    WHERE user_id = ? AND scope = ? AND kind = ?
+    ORDER BY hits DESC, last_seen DESC
+    LIMIT ?
+"""
+
+@cached_read(lambda user_id, scope, kind, limit: [("facts", user_id, scope)], _owned_by_user)
+def top_facts(user_id, scope, kind, limit=20):
+    """The `limit` most reinforced items of `kind`, most recently seen first among ties."""
+    with connection(user_db(user_id)) as conn:
+        rows = conn.execute(_TOP_FACTS_SQL, (user_id, scope, kind, limit)).fetchall()
+    return [row[0] for row in rows]
+
+# --- CONVERSATION SUMMARIES ---
+
+@cached_read(lambda conversation_id: [("summary", conversation_id)], _owned_by_conversation)
+def get_conversation_summary(conversation_id):
+    """Return (summary, through_message_id), or ("", 0) if nothing has been summarised yet."""
+    with connection(conversation_db(conversation_id)) as conn:
+        row = conn.execute(
+            "SELECT summary, through_message_id FROM conversation_summaries WHERE conversation_id = ?",
+            (conversation_id,),
+        ).fetchone()
+    return (row[0], row[1]) if row else ("", 0)
+
+def save_conversation_summary(conversation_id, summary, through_message_id):
+    """Store a newer summary; a stale one (covering fewer messages) is ignored."""
+    with connection(conversation_db(conversation_id)) as conn:
+        conn.execute("""
+            INSERT INTO conversation_summaries (conversation_id, summary, through_message_id)
+            VALUES (?, ?, ?)
+            ON CONFLICT (conversation_id) DO UPDATE SET
+                summary = excluded.summary,
+                through_message_id = excluded.through_message_id,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE excluded.through_message_id > conversation_summaries.through_message_id
+        """, (conversation_id, summary, through_message_id))
+    _invalidate(conversation_db(conversation_id), ("summary", conversation_id))
+
+# --- MOOD HISTORY ---
+# Echo's reply envelope carries the model's "sentiment" for the user's message.
+# It is stored on that message and, in the same transaction, counted in
+# mood_daily and mood_weekly (keyed by the UTC day, and by the Monday that
+# starts its week), so mood trends are read from a few hundred rollup rows even
+# after years of history. The rollups are the mood history: deleting or
+# archiving a chat doesn't rewrite them.
+MOOD_BUCKETS = ("positive", "neutral", "negative", "other")
+MOOD_PERIODS = {"day": "mood_daily", "week": "mood_weekly"}
+_MOOD_WORDS = {
+    "positive": ("positive", "happy", "hopeful", "excited", "grateful", "calm", "content", "proud", "relieved"),
+    "neutral": ("neutral", "mixed"),
+    "negative": ("negative", "sad", "anxious", "angry", "stressed", "frustrated", "depressed", "lonely", "upset", "worried", "overwhelmed"),
+}
+_MOOD_BUCKET_OF = {word: bucket for bucket, words in _MOOD_WORDS.items() for word in words}
+
+def mood_bucket(sentiment):
+    """positive / neutral / negative for the labels we recognise, else other."""
+    return _MOOD_BUCKET_OF.get(str(sentiment).strip().lower(), "other")
+
+def _week_start(day):
+    d = date.fromisoformat(day)
+    return (d - timedelta(days=d.weekday())).isoformat()
+
+def _add_to_mood_rollups(conn, user_id, scope, timestamp, sentiment):
+    bucket = mood_bucket(sentiment)
+    day = str(timestamp)[:10]
+    for table, period in (("mood_daily", day), ("mood_weekly", _week_start(day))):
+        conn.execute(f"""
+            INSERT INTO {table} (user_id, scope, period, {bucket}) VALUES (?, ?, ?, 1)
+            ON CONFLICT (user_id, scope, period) DO UPDATE SET {bucket} = {bucket} + 1
+        """, (user_id, scope, period))
+
+def record_sentiment(conversation_id, message_id, sentiment):
+    """Store the model's sentiment for a user message and count it in the mood rollups (only the first time)."""
+    if not isinstance(sentiment, str) or not sentiment.strip():
+        return
+    sentiment = sentiment.strip()[:40]
+    db_file = conversation_db(conversation_id)
+    with connection(db_file) as conn:
+        cursor = conn.execute(
+            "UPDATE messages SET sentiment = ? WHERE id = ? AND conversation_id = ? AND sentiment IS NULL",
+            (sentiment, message_id, conversation_id),
+        )
+        if not cursor.rowcount:
+            return
+        user_id, scope, timestamp = conn.execute("""
+            SELECT c.user_id, c.scope, m.timestamp
+            FROM messages m JOIN conversations c ON c.id = m.conversation_id
+            WHERE m.id = ?
+        """, (message_id,)).fetchone()
+        _add_to_mood_rollups(conn, user_id, scope, timestamp, sentiment)
+    _invalidate(db_file, ("mood", user_id, scope))
+
+_MOOD_ROLLUP_SQL = """
+    SELECT period, positive, neutral, negative, other
+    FROM {table}
+    WHERE user_id = ? AND scope = ? AND period >= ? AND period < ?
+    ORDER BY period
+"""
+
+@cached_read(lambda user_id, scope, period, since, until: [("mood", user_id, scope)], _owned_by_user)
+def get_mood_rollup(user_id, scope, period="day", since=None, until=None):
+    """
+    (period, positive, neutral, negative, other) rows, oldest first, for
+    period "day" or "week". since/until ("YYYY-MM-DD") bound the period's
+    start date, inclusive of since and exclusive of until.
+    """
+    with connection(user_db(user_id)) as conn:
+        return conn.execute(_MOOD_ROLLUP_SQL.format(table=MOOD_PERIODS[period]), (user_id, scope, since or "", until or "9999")).fetchall()
+
+# --- REPLY LEASES ---
+# At most one assistant reply is generated per conversation at a time, across
+# sessions and processes (see chat_service.AssistantTurn.begin). The lease row
+# names the message being answered and the turn answering it; it is deleted in
+# the transaction that stores the reply, and simply expires if its process dies.
+
+LEASE_ACQUIRED, LEASE_HELD, LEASE_ANSWERED = "acquired", "held", "answered"
+
+def acquire_reply_lease(conversation_id, message_id, owner, ttl):
+    """
+    Take the right to answer message_id for ttl seconds. Returns
+    LEASE_ACQUIRED, LEASE_HELD if another owner holds an unexpired lease on
+    the conversation, or LEASE_ANSWERED if a newer message (e.g. the reply)
+    has been stored since.
+    """
+    now = time.time()
+    db_file = conversation_db(conversation_id)
+    with transaction(db_file) as conn:
+        answered = conn.execute(
+            "SELECT 1 FROM messages WHERE conversation_id = ? AND id > ? LIMIT 1", (conversation_id, message_id)
+        ).fetchone()
+        if answered:
+            # Most likely stored by another process, whose writes this
+            # process's read cache hasn't seen; make the next read fetch it.
+            _invalidate(db_file, ("messages", conversation_id))
+            return LEASE_ANSWERED
+        cursor = conn.execute("""
+            INSERT INTO reply_leases (conversation_id, message_id, owner, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (conversation_id) DO UPDATE SET
+                message_id = excluded.message_id, owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE reply_leases.expires_at < ? OR reply_leases.owner = excluded.owner
+        """, (conversation_id, message_id, owner, now + ttl, now))
+        return LEASE_ACQUIRED if cursor.rowcount else LEASE_HELD
+
+def release_reply_lease(conversation_id, owner):
+    with connection(conversation_db(conversation_id)) as conn:
+        conn.execute("DELETE FROM reply_leases WHERE conversation_id = ? AND owner = ?", (conversation_id, owner))
+
+def reply_lease_expiry(conversation_id):
+    """When the unexpired lease on conversation_id runs out (a time.time() value), or None if there is none."""
+    with connection(conversation_db(conversation_id)) as conn:
+        row = conn.execute(
+            "SELECT expires_at FROM reply_leases WHERE conversation_id = ? AND expires_at >= ?", (conversation_id, time.time())
+        ).fetchone()
+    return row[0] if row else None
+
+# --- SEARCH ---
+
+def _fts_query(text):
+    """Turn free text into a safe FTS5 query: every word must match, the last as a prefix."""
+    terms = [term.replace('"', '""') for term in text.split()]
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return "content : (" + " ".join(quoted) + ")"
+
+_SEARCH_SQL = """
+    SELECT m.id, m.conversation_id, COALESCE(c.title_override, c.title),
+           snippet(messages_fts, 0, '**', '**', '…', 16)
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    JOIN conversations c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH ? AND c.user_id = ? AND c.scope = ?
+    ORDER BY rank
+    LIMIT ?
+"""
+
+def search_messages(user_id, scope, text, limit=20):
+    """
+    Ranked full-text search over one user's messages in one scope. Returns
+    dicts with the message id, its conversation, the conversation's display
+    title and a snippet with the matches wrapped in **.
+    """
+    query = _fts_query(text)
+    if query is None:
+        return []
+    with connection(user_db(user_id)) as conn:
+        rows = conn.execute(_SEARCH_SQL, (f'owner : "u{int(user_id)}{scope}" AND {query}', user_id, scope, limit)).fetchall()
+    return [
+        {"message_id": row[0], "conversation_id": row[1], "title": row[2], "snippet": row[3]}
+        for row in rows
+    ]
+
+def rebuild_search_index(db_file=None):
+    """Re-index every message from scratch (e.g. after restoring an old backup)."""
+    with connection(db_file) as conn:
+        conn.execute("DELETE FROM messages_fts")
+        conn.execute(_FTS_INSERT_SQL)
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+
+# --- COLD STORAGE ---
+# An archived conversation's messages are packed into a single compressed
+# row of conversation_archives and removed from `messages` (and so from the
+# search index). They come back, with their original ids, when the chat is
+# restored, or its messages are next read or written to. Message ids are AUTOINCREMENT, so
+# they are never handed out again in the meantime.
+ARCHIVE_CODEC = os.getenv("ECHO_ARCHIVE_CODEC", "zlib")
+_CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 9), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+def _unpack_archive(codec, payload):
+    """The archived rows as (id, role, content, avatar, timestamp, sentiment) lists (no sentiment in older archives)."""
+    return json.loads(_CODECS[codec][1](payload))
+
+_ARCHIVE_EXISTS_SQL = "SELECT 1 FROM conversation_archives WHERE conversation_id = ?"
+
+def _rehydrate(conn, conversation_id):
+    """Unpack conversation_id's archive back into `messages`, if it has one. Returns whether it did."""
+    # Checked first so that reads of unarchived chats never take the write lock.
+    if not conn.execute(_ARCHIVE_EXISTS_SQL, (conversation_id,)).fetchone():
+        return False
+    # Claiming the row by deleting it means only one of several concurrent readers unpacks it.
+    row = conn.execute(
+        "DELETE FROM conversation_archives WHERE conversation_id = ? RETURNING codec, payload", (conversation_id,)
+    ).fetchall()
+    if not row:
+        return False
+    row = row[0]
+    conn.executemany(
+        "INSERT INTO messages (id, conversation_id, role, content, avatar, timestamp, sentiment) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(m[0], conversation_id, *m[1:5], m[5] if len(m) > 5 else None) for m in _unpack_archive(*row)],
+    )
+    _invalidate(conversation_db(conversation_id), ("messages", conversation_id))
+    return True
+
+def archive_messages(conversation_id, codec=None):
+    """
+    Move a conversation's messages to cold storage. Returns
+    {"messages", "raw_bytes", "packed_bytes"}, or None if it had none.
+    """
+    codec = codec or ARCHIVE_CODEC
+    with connection(conversation_db(conversation_id)) as conn:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        # Anything already packed is merged with rows added since.
+        _rehydrate(conn, conversation_id)
+        rows = conn.execute(
+            "SELECT id, role, content, avatar, timestamp, sentiment FROM messages WHERE conversation_id = ? ORDER BY id",
+            (conversation_id,),
+        ).fetchall()
+        if not rows:
+            return None
+        raw = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        payload = _CODECS[codec][0](raw)
+        conn.execute(
+            "INSERT INTO conversation_archives (conversation_id, codec, payload, message_count, raw_bytes, packed_bytes) VALUES (?, ?, ?, ?, ?, ?)",
+            (conversation_id, codec, payload, len(rows), len(raw), len(payload)),
+        )
+        conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+        _invalidate(conversation_db(conversation_id), ("messages", conversation_id))
+    return {"messages": len(rows), "raw_bytes": len(raw), "packed_bytes": len(payload)}
+
+def cold_storage_stats(db_file=None):
+    """Totals over every archived conversation: how much the cold tier saves."""
+    with connection(db_file) as conn:
+        row = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(message_count), 0), COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(packed_bytes), 0) FROM conversation_archives"
+        ).fetchone()
+    return {"conversations": row[0], "messages": row[1], "raw_bytes": row[2], "packed_bytes": row[3], "saved_bytes": row[2] - row[3]}
+
+# --- QUERY PLAN CHECKS ---
+# The queries a normal rerun issues, as the functions above run them (other
+# modules add theirs, e.g. jobs.py). check_query_plans() fails loudly if any
+# of them stops using an index, e.g. after a schema change drops one.
+HOT_QUERIES = {
+    "recall": (_RECALL_SQL, (1, "public", "facts")),
+    "get_conversations": (_CONVERSATIONS_SQL, (1, "public")),
+    "get_conversation_list": (_CONVERSATION_LIST_SQL, (1, "public")),
+    "get_conversation_title": (_CONVERSATION_TITLE_SQL, (1,)),
+    "get_messages": (_MESSAGES_SQL, (1,)),
+    "get_messages_page": (_MESSAGES_BEFORE_SQL, (1, 100, 50)),
+    "get_messages_after": (_MESSAGES_AFTER_SQL, (1, 100, 50)),
+    "top_facts": (_TOP_FACTS_SQL, (1, "public", "fact", 20)),
+    "search_messages": (_SEARCH_SQL, ('owner : "u1public" AND content : ("hello"*)', 1, "public", 20)),
+    "resume_session": (_RESUME_SESSION_SQL, ("x", 0)),
+    "count_messages": (_COUNT_MESSAGES_SQL, (1, 1)),
+    "check_archive": (_ARCHIVE_EXISTS_SQL, (1,)),
+    "get_mood_rollup": (_MOOD_ROLLUP_SQL.format(table="mood_daily"), (1, "public", "", "9999")),
+    "get_mood_rollup_weekly": (_MOOD_ROLLUP_SQL.format(table="mood_weekly"), (1, "public", "", "9999")),
+    "clear_conversation": (_CLEAR_MESSAGES_SQL, (1,)),
+    "delete_conversation": (_DELETE_CONVERSATION_SQL, (1,)),
+}
+
+def check_query_plans(db_file=None):
+    """
+    Run EXPLAIN QUERY PLAN over HOT_QUERIES and return {name: [offending plan steps]}
+    for every query that does a full table scan or sorts in a temp b-tree.
+    An empty dict means every hot query is index-backed.
+    """
+    problems = {}
+    with connection(db_file) as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            steps = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            bad = [
+                step for step in steps
+                if (step.startswith("SCAN ") and "INDEX" not in step and step != "SCAN CONSTANT ROW") or "TEMP B-TREE" in step
+            ]
+            if bad:
+                problems[name] = bad
+    return problems
+
+# --- TRACING ---
+# Time every public function above when ECHO_TRACING=1 (no-op otherwise).
+# Keep this at the end of the module so new functions are covered too.
+instrument(globals(), "memory", skip=(
+    "connection", "transaction", "on_commit", "get_pool", "close_connections", "schema_version",
+    "user_db", "conversation_db", "shard_file", "shard_for_user", "cached_read", "mood_bucket",
+    "hash_password", "normalize_fact",
+))
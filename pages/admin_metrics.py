@@ -0,0 +1,65 @@
+import os
+import streamlit as st
+import memory
+import tracing
+from llm_cache import CACHE_ENABLED
+
+# --- ADMIN: LATENCY METRICS ---
+# Where a slow turn spent its time: SQLite, the model, JSON parsing or rendering.
+# Only usernames listed in ECHO_ADMIN_USERS (comma-separated) can see it.
+ADMIN_USERS = {name.strip() for name in os.getenv("ECHO_ADMIN_USERS", "").split(",") if name.strip()}
+
+st.set_page_config(page_title="Echo · Metrics", layout="wide")
+
+if st.session_state.get("username") not in ADMIN_USERS:
+    st.error("This page is only available to administrators.")
+    st.stop()
+
+st.title("Latency metrics")
+if not tracing.ENABLED:
+    st.info("Tracing is off. Start the app with ECHO_TRACING=1 to record spans.")
+    st.stop()
+
+st.subheader("Slowest recent reruns")
+limit = st.slider("Reruns to show", 5, 50, 15)
+for rerun in tracing.recent_reruns(limit=limit, slowest=True):
+    header = f"{rerun['duration_ms']:.1f} ms · {rerun['label']} · {rerun['user'] or 'anonymous'} · #{rerun['id']}"
+    if rerun["counters"].get("prompt_tokens.dynamic"):
+        header += f" · prompt ~{rerun['counters']['prompt_tokens.static']} static + {rerun['counters']['prompt_tokens.dynamic']} dynamic tokens"
+    with st.expander(header):
+        st.dataframe(
+            [
+                {
+                    "span": "  " * s["depth"] + s["name"],
+                    "start (ms)": s["offset_ms"],
+                    "duration (ms)": s["duration_ms"],
+                    "error": s["error"] or "",
+                }
+                for s in sorted(rerun["spans"], key=lambda s: s["offset_ms"])
+            ],
+            use_container_width=True,
+        )
+
+st.subheader("By operation")
+summary = tracing.histogram_summary()
+st.dataframe(
+    [{"span": name, **stats} for name, stats in sorted(summary.items(), key=lambda kv: -kv[1]["mean_ms"] * kv[1]["count"])],
+    use_container_width=True,
+)
+
+if CACHE_ENABLED:
+    from echo_api import get_provider
+    try:
+        st.subheader("LLM response cache")
+        st.json(get_provider().cache.stats())
+    except Exception as e:
+        st.caption(f"Cache stats unavailable: {e}")
+
+st.subheader("Read cache")
+if memory.READ_CACHE_ENABLED:
+    st.json(memory.read_cache.stats())
+else:
+    st.caption("Off (ECHO_READ_CACHE=0).")
+
+with st.expander("Prometheus export"):
+    st.code(tracing.prometheus_text(), language="text")
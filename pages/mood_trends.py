@@ -0,0 +1,81 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from memory import MOOD_BUCKETS, get_mood_rollup
+
+# --- MOOD TRENDS ---
+# Reads only the mood_daily / mood_weekly rollups (see MOOD HISTORY in
+# memory.py), one row per day or week however long the history, and does
+# any coarser or custom aggregation here with pandas.
+GRANULARITIES = ("Day", "Week", "Month", "Quarter")
+RESAMPLE_RULES = {"Month": "MS", "Quarter": "QS"}
+SCORED = ["positive", "neutral", "negative"]
+
+st.set_page_config(page_title="Echo · Mood", layout="wide")
+
+if not st.session_state.get("user_id"):
+    st.error("Log in to see your mood trends.")
+    st.stop()
+
+scope = "private" if st.session_state.get("private_mode") else "public"
+
+def load(period, since, until):
+    """Rollup rows for [since, until) as a DataFrame of counts indexed by period start."""
+    rows = get_mood_rollup(st.session_state.user_id, scope, period, since.isoformat(), until.isoformat())
+    frame = pd.DataFrame(rows, columns=("period", *MOOD_BUCKETS))
+    frame.index = pd.DatetimeIndex(pd.to_datetime(frame.pop("period")))
+    return frame
+
+def mood_score(counts):
+    """(positive - negative) / scored messages per row: -1 (all negative) to 1; NaN where nothing was scored."""
+    scored = counts[SCORED].to_numpy().sum(axis=1)
+    balance = (counts["positive"] - counts["negative"]).to_numpy(dtype=float)
+    score = np.divide(balance, scored, out=np.full(len(counts), np.nan), where=scored > 0)
+    return pd.Series(score, index=counts.index, name="mood")
+
+st.title("Mood trends")
+if scope == "private":
+    st.caption("Private Mode: showing your private conversations only.")
+
+today = date.today()
+col_range, col_grain = st.columns([2, 3])
+with col_range:
+    picked = st.date_input("Range", (today - timedelta(days=90), today), max_value=today)
+with col_grain:
+    granularity = st.radio("Group by", GRANULARITIES, horizontal=True)
+if not isinstance(picked, (tuple, list)) or len(picked) != 2:
+    st.info("Pick a start and an end date.")
+    st.stop()
+start, end = picked
+until = end + timedelta(days=1)
+
+if granularity == "Week":
+    week_start = start - timedelta(days=start.weekday())
+    counts = load("week", week_start, until)
+    counts = counts.reindex(pd.date_range(week_start, end, freq="W-MON"), fill_value=0)
+else:
+    counts = load("day", start, until).reindex(pd.date_range(start, end, freq="D"), fill_value=0)
+    if granularity in RESAMPLE_RULES:
+        counts = counts.resample(RESAMPLE_RULES[granularity]).sum()
+
+if not counts.to_numpy().any():
+    st.info("No moods recorded in this range yet. Echo notes how you're feeling as you chat.")
+    st.stop()
+
+totals = counts.sum()
+overall = mood_score(totals.to_frame().T).iloc[0]
+col_score, col_messages, col_best = st.columns(3)
+col_score.metric("Mood score", "–" if np.isnan(overall) else f"{overall:+.2f}", help="From -1 (every message negative) to +1 (every message positive).")
+col_messages.metric("Messages", f"{int(totals.sum()):,}")
+col_best.metric("Most common", totals.idxmax().title())
+
+scores = mood_score(counts)
+if granularity == "Day" and len(scores) > 14:
+    scores = scores.to_frame().assign(**{"7-day average": mood_score(counts.rolling(7, min_periods=1).sum())})
+st.subheader("Mood over time")
+st.line_chart(scores)
+st.subheader("Messages by mood")
+st.bar_chart(counts[list(MOOD_BUCKETS)])
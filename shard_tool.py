@@ -0,0 +1,199 @@
+"""
+Move between a single echo.db and a sharded layout (see SHARDING in memory.py).
+
+    python shard_tool.py split echo.db shards/                 # one shard file per user
+    python shard_tool.py split echo.db shards/ --shards 16     # users hashed into 16 files
+    python shard_tool.py merge shards/ merged.db
+    python shard_tool.py drop-user shards/ alice
+
+split copies accounts, sessions and jobs into shards/directory.db and each
+user's conversations, messages, memories, facts and mood history into their shard; merge
+does the reverse. Ids are kept, so sessions, links and summaries stay valid
+either way. Then run the app with ECHO_SHARD_DIR=shards/ (and the same
+ECHO_SHARD_COUNT). Run these while the app is stopped.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+from collections import defaultdict
+
+import memory
+
+# Per-user tables, parents first, with the rows of the users in temp.moving_users.
+USER_TABLES = (
+    ("memories", "user_id IN (SELECT id FROM temp.moving_users)"),
+    ("user_facts", "user_id IN (SELECT id FROM temp.moving_users)"),
+    ("mood_daily", "user_id IN (SELECT id FROM temp.moving_users)"),
+    ("mood_weekly", "user_id IN (SELECT id FROM temp.moving_users)"),
+    ("conversations", "user_id IN (SELECT id FROM temp.moving_users)"),
+    ("messages", "conversation_id IN (SELECT id FROM main.conversations)"),
+    ("conversation_summaries", "conversation_id IN (SELECT id FROM main.conversations)"),
+    ("conversation_archives", "conversation_id IN (SELECT id FROM main.conversations)"),
+)
+# Ids nothing refers to; shards allocate them independently, so let the target reassign them.
+RENUMBERED = ("memories", "user_facts")
+
+def _configure(shard_dir, shard_count):
+    memory.SHARD_DIR = shard_dir
+    memory.SHARD_COUNT = shard_count
+    memory.DB_FILE = os.path.join(shard_dir, "directory.db")
+
+def _copy_user_rows(target, source, user_ids=None, with_users=False):
+    """Copy the per-user rows of user_ids (default: every user in source) from source into target."""
+    conn = sqlite3.connect(target, isolation_level=None)
+    try:
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("ATTACH DATABASE ? AS src", (source,))
+        conn.execute("CREATE TEMP TABLE moving_users (id INTEGER PRIMARY KEY)")
+        if user_ids is None:
+            conn.execute("INSERT INTO temp.moving_users SELECT id FROM src.users")
+        else:
+            conn.executemany("INSERT INTO temp.moving_users VALUES (?)", [(u,) for u in user_ids])
+        conn.execute("BEGIN")
+        if with_users:
+            # Only there for the foreign keys; the password hash stays in the directory.
+            conn.execute("""
+                INSERT OR IGNORE INTO main.users (id, username, password_hash)
+                SELECT id, username, '' FROM src.users WHERE id IN (SELECT id FROM temp.moving_users)
+            """)
+        counts = {}
+        for table, where in USER_TABLES:
+            columns = [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")]
+            if table in RENUMBERED:
+                columns.remove("id")
+            column_list = ", ".join(columns)
+            counts[table] = conn.execute(
+                f"INSERT INTO main.{table} ({column_list}) SELECT {column_list} FROM src.{table} WHERE {where}"
+            ).rowcount
+        conn.execute("COMMIT")
+        conn.execute("DROP TABLE temp.moving_users")
+        conn.execute("DETACH DATABASE src")
+    finally:
+        conn.close()
+    return counts
+
+def _vacuum_into(source, target):
+    conn = sqlite3.connect(source)
+    try:
+        conn.execute("VACUUM INTO ?", (target,))
+    finally:
+        conn.close()
+
+def split(source, shard_dir, shard_count=0):
+    directory = os.path.join(shard_dir, "directory.db")
+    if os.path.exists(directory):
+        sys.exit(f"{directory} already exists")
+    os.makedirs(shard_dir, exist_ok=True)
+    memory.migrate(source)
+    memory.close_connections()
+    _vacuum_into(source, directory)
+
+    _configure(shard_dir, shard_count)
+    memory.init_db()
+    with memory.connection() as conn:
+        user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+    by_shard = defaultdict(list)
+    for user_id in user_ids:
+        by_shard[memory.shard_for_user(user_id)].append(user_id)
+
+    totals = defaultdict(int)
+    for shard, members in sorted(by_shard.items()):
+        path = memory.shard_file(shard)
+        if os.path.exists(path):
+            sys.exit(f"{path} already exists")
+        memory.open_shard(shard)
+        for table, n in _copy_user_rows(path, source, members, with_users=True).items():
+            totals[table] += n
+
+    # The directory keeps only accounts and routing from here on.
+    with memory.connection() as conn:
+        conn.executemany(
+            "INSERT INTO user_shards (user_id, shard) VALUES (?, ?)",
+            [(user_id, shard) for shard, members in by_shard.items() for user_id in members],
+        )
+        conn.execute("INSERT INTO conversation_shards (conversation_id, user_id) SELECT id, user_id FROM conversations")
+        conn.execute("DELETE FROM messages_fts")
+        for table in ("conversations", "memories", "user_facts", "mood_daily", "mood_weekly"):
+            conn.execute(f"DELETE FROM {table}")
+    with memory.connection() as conn:
+        conn.execute("VACUUM")
+    memory.close_connections()
+    print(f"Split {len(user_ids)} users into {len(by_shard)} shard(s) in {shard_dir}: " + _describe(totals))
+
+def merge(shard_dir, output):
+    if os.path.exists(output):
+        sys.exit(f"{output} already exists")
+    _configure(shard_dir, memory.SHARD_COUNT)
+    memory.init_db()
+    shards = memory.shard_files()
+    memory.close_connections()
+    _vacuum_into(memory.DB_FILE, output)
+
+    conn = sqlite3.connect(output)
+    with conn:
+        conn.execute("DELETE FROM user_shards")
+        conn.execute("DELETE FROM conversation_shards")
+    conn.close()
+    totals = defaultdict(int)
+    for path in shards:
+        for table, n in _copy_user_rows(output, path).items():
+            totals[table] += n
+    print(f"Merged {len(shards)} shard(s) into {output}: " + _describe(totals))
+
+def drop_user(shard_dir, username, shard_count):
+    """Delete a user and everything they own; with one file per user that is an unlink."""
+    _configure(shard_dir, shard_count)
+    memory.init_db()
+    with memory.connection() as conn:
+        row = conn.execute("""
+            SELECT u.id, s.shard, (SELECT COUNT(*) FROM user_shards o WHERE o.shard = s.shard)
+            FROM users u LEFT JOIN user_shards s ON s.user_id = u.id WHERE u.username = ?
+        """, (username,)).fetchone()
+    if row is None:
+        sys.exit(f"No such user: {username}")
+    user_id, shard, sharers = row
+    if shard is not None:
+        path = memory.shard_file(shard)
+        if sharers == 1:
+            memory.close_connections()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+        else:
+            with memory.connection(memory.open_shard(shard)) as conn:
+                conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+    with memory.connection() as conn:
+        # Sessions and routing rows go with it via ON DELETE CASCADE.
+        conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+    print(f"Deleted {username}" + (f" and {memory.shard_file(shard)}" if shard is not None and sharers == 1 else ""))
+
+def _describe(totals):
+    return ", ".join(f"{n} {table}" for table, n in totals.items())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Split echo.db into per-user shards, or merge shards back.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    split_cmd = commands.add_parser("split", help="shard an existing database")
+    split_cmd.add_argument("source")
+    split_cmd.add_argument("shard_dir")
+    split_cmd.add_argument("--shards", type=int, default=memory.SHARD_COUNT, help="hash users into this many files (0: one per user)")
+    merge_cmd = commands.add_parser("merge", help="combine a shard directory into one database")
+    merge_cmd.add_argument("shard_dir")
+    merge_cmd.add_argument("output")
+    drop_cmd = commands.add_parser("drop-user", help="delete a user and all their data")
+    drop_cmd.add_argument("shard_dir")
+    drop_cmd.add_argument("username")
+    drop_cmd.add_argument("--shards", type=int, default=memory.SHARD_COUNT)
+    args = parser.parse_args(argv)
+
+    if args.command == "split":
+        split(args.source, args.shard_dir, args.shards)
+    elif args.command == "merge":
+        merge(args.shard_dir, args.output)
+    else:
+        drop_user(args.shard_dir, args.username, args.shards)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
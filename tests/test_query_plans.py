@@ -0,0 +1,28 @@
+import pytest
+
+import jobs  # noqa: F401  (registers the job queue's hot query)
+import memory
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(memory, "DB_FILE", str(tmp_path / "echo.db"))
+    monkeypatch.setattr(memory, "SHARD_DIR", "")
+    memory.init_db()
+    yield memory.DB_FILE
+    memory.close_connections()
+
+
+def test_hot_queries_use_indexes(fresh_db):
+    assert memory.check_query_plans() == {}
+
+
+def test_dropped_index_is_reported(fresh_db):
+    with memory.connection() as conn:
+        indexes = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'user_facts' AND sql IS NOT NULL"
+        )]
+        assert indexes
+        for name in indexes:
+            conn.execute(f"DROP INDEX {name}")
+    assert "top_facts" in memory.check_query_plans()
@@ -0,0 +1,247 @@
+import functools
+import inspect
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- LATENCY TRACING ---
+# Spans time individual steps (a memory.py call, an LLM request, building the
+# sidebar). Spans recorded on a Streamlit script thread are attached to that
+# thread's current rerun; the last RING_SIZE reruns are kept in memory for the
+# admin metrics page. Every span also feeds a per-name histogram, exported in
+# Prometheus text format, and count() keeps running totals (e.g. prompt tokens)
+# the same way.
+#
+# Tracing is off unless ECHO_TRACING=1 is set before startup. When it is off,
+# traced() hands back the undecorated function and span() a shared no-op, so
+# the cost is nil.
+
+ENABLED = os.getenv("ECHO_TRACING", "0") == "1"
+RING_SIZE = int(os.getenv("ECHO_TRACING_RING_SIZE", "200"))
+METRICS_FILE = os.getenv("ECHO_METRICS_FILE")
+METRICS_FILE_INTERVAL = 10.0   # seconds between rewrites of METRICS_FILE
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_local = threading.local()
+_lock = threading.Lock()
+_reruns = deque(maxlen=RING_SIZE)
+_histograms = {}     # name -> [bucket counts..., +Inf count], sum, count
+_counters = {}       # name -> running total
+_rerun_ids = itertools.count(1)
+_last_file_write = 0.0
+
+def _observe(name, seconds):
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[0][i] += 1
+                break
+        else:
+            hist[0][-1] += 1
+        hist[1] += seconds
+        hist[2] += 1
+
+class _Span:
+    __slots__ = ("name", "start", "depth", "rerun")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.rerun = getattr(_local, "rerun", None)
+        self.depth = getattr(_local, "depth", 0)
+        _local.depth = self.depth + 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        _local.depth = self.depth
+        _observe(self.name, end - self.start)
+        rerun = self.rerun
+        if rerun is not None:
+            offset_ms = (self.start - rerun["t0"]) * 1000
+            duration_ms = (end - self.start) * 1000
+            rerun["spans"].append({
+                "name": self.name, "offset_ms": round(offset_ms, 3),
+                "duration_ms": round(duration_ms, 3), "depth": self.depth,
+                "error": exc_type.__name__ if exc_type else None,
+            })
+            rerun["duration_ms"] = max(rerun["duration_ms"], round(offset_ms + duration_ms, 3))
+        return False
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP = _NoopSpan()
+
+def span(name):
+    """Context manager timing the enclosed block as `name`."""
+    return _Span(name) if ENABLED else _NOOP
+
+def traced(name=None):
+    """Decorator timing every call of the function (as `name`, default module.function)."""
+    def decorate(func):
+        if not ENABLED:
+            return func
+        label = name or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Span(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def instrument(namespace, prefix, skip=()):
+    """Wrap every public function defined in a module's namespace (pass globals())."""
+    if not ENABLED:
+        return
+    module = namespace["__name__"]
+    for name, obj in list(namespace.items()):
+        if inspect.isfunction(obj) and obj.__module__ == module and not name.startswith("_") and name not in skip:
+            namespace[name] = traced(f"{prefix}.{name}")(obj)
+
+def count(name, amount=1):
+    """Add amount to the counter `name`, and to the current rerun's own tally."""
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+    rerun = getattr(_local, "rerun", None)
+    if rerun is not None:
+        rerun["counters"][name] = rerun["counters"].get(name, 0) + amount
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+def start_rerun(label, user=None):
+    """Begin recording a rerun on this thread. Spans until end_rerun() (or the next start) belong to it."""
+    if not ENABLED:
+        return
+    rerun = {
+        "id": next(_rerun_ids), "label": label, "user": user,
+        "started": time.time(), "t0": time.perf_counter(),
+        "duration_ms": 0.0, "spans": [], "counters": {}, "finished": False,
+    }
+    _local.rerun = rerun
+    _local.depth = 0
+    with _lock:
+        _reruns.append(rerun)
+
+def end_rerun():
+    """
+    Close this thread's rerun. Streamlit scripts often end in st.rerun()/st.stop()
+    before reaching it, so a rerun's duration is also kept up to date as each
+    span finishes (it runs to the end of its last traced step).
+    """
+    global _last_file_write
+    rerun = getattr(_local, "rerun", None)
+    if rerun is None:
+        return
+    rerun["duration_ms"] = round((time.perf_counter() - rerun["t0"]) * 1000, 3)
+    rerun["finished"] = True
+    _local.rerun = None
+    _observe(f"rerun.{rerun['label']}", rerun["duration_ms"] / 1000)
+    if METRICS_FILE and time.time() - _last_file_write >= METRICS_FILE_INTERVAL:
+        _last_file_write = time.time()
+        write_prometheus(METRICS_FILE)
+
+def recent_reruns(limit=None, slowest=False):
+    """Copies of the recorded reruns, newest first (or slowest first)."""
+    with _lock:
+        reruns = [dict(r, spans=list(r["spans"]), counters=dict(r["counters"])) for r in _reruns]
+    reruns.sort(key=(lambda r: r["duration_ms"]) if slowest else (lambda r: r["id"]), reverse=True)
+    return reruns[:limit] if limit else reruns
+
+def histogram_summary():
+    """{name: {"count", "mean_ms", "p50_ms", "p95_ms"}}; percentiles are bucket upper bounds."""
+    with _lock:
+        snapshot = {name: (list(h[0]), h[1], h[2]) for name, h in _histograms.items()}
+    summary = {}
+    for name, (counts, total, count) in snapshot.items():
+        def quantile(q):
+            target, seen = q * count, 0
+            for bound, n in zip(BUCKETS + (float("inf"),), counts):
+                seen += n
+                if seen >= target:
+                    return bound * 1000
+        summary[name] = {
+            "count": count, "mean_ms": round(total / count * 1000, 3) if count else 0.0,
+            "p50_ms": quantile(0.5), "p95_ms": quantile(0.95),
+        }
+    return summary
+
+def prometheus_text():
+    """All span histograms and counters in the Prometheus text exposition format."""
+    with _lock:
+        snapshot = {name: (list(h[0]), h[1], h[2]) for name, h in _histograms.items()}
+        totals = dict(_counters)
+    lines = [
+        "# HELP echo_span_duration_seconds Time spent in traced Echo operations.",
+        "# TYPE echo_span_duration_seconds histogram",
+    ]
+    for name in sorted(snapshot):
+        counts, total, count = snapshot[name]
+        cumulative = 0
+        for bound, n in zip(BUCKETS, counts):
+            cumulative += n
+            lines.append(f'echo_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'echo_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {count}')
+        lines.append(f'echo_span_duration_seconds_sum{{span="{name}"}} {total:.6f}')
+        lines.append(f'echo_span_duration_seconds_count{{span="{name}"}} {count}')
+    if totals:
+        lines.append("# HELP echo_counter_total Running totals counted by Echo, e.g. prompt tokens.")
+        lines.append("# TYPE echo_counter_total counter")
+        for name in sorted(totals):
+            lines.append(f'echo_counter_total{{counter="{name}"}} {totals[name]}')
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path):
+    """Atomically (re)write the metrics file, e.g. for node_exporter's textfile collector."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_metrics_server(port=None):
+    """Serve /metrics on ECHO_METRICS_PORT (once per process; no-op if unset or tracing is off)."""
+    global _server
+    port = port or os.getenv("ECHO_METRICS_PORT")
+    if not ENABLED or not port:
+        return
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("127.0.0.1", int(port)), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="echo-metrics", daemon=True).start()
@@ -1,51 +1,48 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import html
 import json
 from memory import (
     remember, recall, create_conversation, get_conversations,
-    update_password, clear_conversation, delete_conversation
+    update_password, clear_conversation, delete_conversation,
+    get_conversation_list, set_conversation_pinned, set_conversation_archived,
+    set_conversation_title_override, search_messages, end_session, forget_private,
+    SESSION_TTL_SECONDS,
 )
 # ---------------------
 # Helper utilities
 # ---------------------
-META_SCOPE = "meta"  # we store per-conversation metadata under this scope
-def _get_meta(user_id, convo_id):
-    """Return dict metadata for a convo (pinned, archived, title_override)."""
-    raw = recall(user_id, META_SCOPE, f"convo_meta_{convo_id}")
-    if not raw:
-        return {"pinned": False, "archived": False, "title": None}
-    try:
-        return json.loads(raw)
-    except Exception:
-        return {"pinned": False, "archived": False, "title": None}
-
-def _set_meta(user_id, convo_id, meta):
-    """Persist metadata dict for a convo."""
-    remember(user_id, META_SCOPE, f"convo_meta_{convo_id}", json.dumps(meta))
-
 def pin_conversation(user_id, convo_id, pin=True):
-    meta = _get_meta(user_id, convo_id)
-    meta["pinned"] = bool(pin)
-    _set_meta(user_id, convo_id, meta)
+    set_conversation_pinned(user_id, convo_id, pin)
 
 def archive_conversation(user_id, convo_id, archive=True):
-    meta = _get_meta(user_id, convo_id)
-    meta["archived"] = bool(archive)
-    _set_meta(user_id, convo_id, meta)
+    packed = set_conversation_archived(user_id, convo_id, archive)
+    if packed:
+        saved_kb = (packed["raw_bytes"] - packed["packed_bytes"]) / 1024
+        st.toast(f"Archived {packed['messages']} messages, {saved_kb:,.1f} KB saved.")
 
 def rename_conversation(user_id, convo_id, new_title):
-    meta = _get_meta(user_id, convo_id)
-    meta["title"] = new_title
-    _set_meta(user_id, convo_id, meta)
+    set_conversation_title_override(user_id, convo_id, new_title)
+
+SESSION_COOKIE = "echo_session"
 
-def get_display_title(user_id, convo_id, original_title):
-    meta = _get_meta(user_id, convo_id)
-    return meta.get("title") or original_title
+def write_session_cookie(token):
+    """
+    Store the session token in a cookie (or delete it, for token=None) so a
+    refresh can restore the login from st.context.cookies. Streamlit can't
+    send Set-Cookie headers, so this runs as a script in the page: the cookie
+    is SameSite=Strict (and Secure over https) but can't be HttpOnly.
+    """
+    value, max_age = (token, SESSION_TTL_SECONDS) if token else ("", 0)
+    components.html(f"""<script>
+        window.parent.document.cookie = {json.dumps(f"{SESSION_COOKIE}={value}; Max-Age={max_age}; Path=/; SameSite=Strict")}
+            + (window.parent.location.protocol === "https:" ? "; Secure" : "");
+    </script>""", height=0)
 # ---------------------
 # UI: Sidebar (Cleaned Up)
 # ---------------------
 # The helper functions at the top of the file remain the same...
-# (_get_meta, _set_meta, etc.)
+# (pin_conversation, archive_conversation, etc.)
 
 # ---------------------
 # UI: Sidebar (BULLETPROOF VERSION)
@@ -132,26 +129,29 @@ def show_sidebar(active_conversation_id):
     
     st.sidebar.subheader("Your Conversations")
 
-    raw_convos = get_conversations(user_id, current_scope) or []
-    pinned, unpinned, archived = [], [], []
-
-    for convo_id, convo_title in raw_convos:
-        meta = _get_meta(user_id, convo_id)
-        display_title = get_display_title(user_id, convo_id, convo_title)
-        convo_data = (convo_id, display_title, meta)
-        
-        if meta.get("archived"):
-            archived.append(convo_data)
-        elif meta.get("pinned"):
-            pinned.append(convo_data)
-        else:
-            unpinned.append(convo_data)
+    # ------- Search -------
+    search_text = st.sidebar.text_input("Search your chats", key=f"search_{current_scope}", placeholder="Search messages…")
+    if search_text.strip():
+        results = search_messages(user_id, current_scope, search_text)
+        if not results:
+            st.sidebar.caption("No matches.")
+        for hit in results:
+            if st.sidebar.button(hit["title"], key=f"hit_{hit['message_id']}", use_container_width=True):
+                st.session_state[active_convo_key] = hit["conversation_id"]
+                st.session_state.jump_to_message = hit["message_id"]
+                st.rerun()
+            st.sidebar.caption(hit["snippet"])
+        st.sidebar.divider()
 
-    ordered = pinned + unpinned
+    # One query, already sorted: pinned first, then newest, archived last.
+    convos = get_conversation_list(user_id, current_scope)
+    ordered = [c for c in convos if not c["archived"]]
+    archived = [c for c in convos if c["archived"]]
 
     st.sidebar.markdown('<div class="conversation-list">', unsafe_allow_html=True)
 
-    for convo_id, display_title, meta in ordered:
+    for convo in ordered:
+        convo_id, display_title = convo["id"], convo["title"]
         is_active = (convo_id == active_conversation_id)
         
         col_main, col_dot = st.sidebar.columns([0.82, 0.18])
@@ -173,9 +173,9 @@ def show_sidebar(active_conversation_id):
                 
                 st.divider()
 
-                pin_text = "Unpin" if meta.get("pinned") else "Pin"
+                pin_text = "Unpin" if convo["pinned"] else "Pin"
                 if st.button(pin_text, key=f"pin_{convo_id}", use_container_width=True):
-                    pin_conversation(user_id, convo_id, not meta.get("pinned"))
+                    pin_conversation(user_id, convo_id, not convo["pinned"])
                     st.rerun()
 
                 if st.button("Archive", key=f"archive_{convo_id}", use_container_width=True):
@@ -186,7 +186,6 @@ def show_sidebar(active_conversation_id):
                 
                 if st.button("Delete", type="primary", key=f"delete_{convo_id}", use_container_width=True):
                     delete_conversation(convo_id)
-                    remember(user_id, META_SCOPE, f"convo_meta_{convo_id}", None)
                     if st.session_state.get(active_convo_key) == convo_id:
                         st.session_state[active_convo_key] = None
                     st.rerun()
@@ -196,7 +195,8 @@ def show_sidebar(active_conversation_id):
     if archived:
         st.sidebar.divider()
         with st.sidebar.expander(f"Archived ({len(archived)})", expanded=False):
-            for convo_id, display_title, meta in archived:
+            for convo in archived:
+                convo_id, display_title = convo["id"], convo["title"]
                 col1, col2 = st.columns([0.8, 0.2])
                 with col1:
                     if st.button(display_title, key=f"select_arch_{convo_id}", use_container_width=True):
@@ -210,7 +210,6 @@ def show_sidebar(active_conversation_id):
                             st.rerun()
                         if st.button("Delete", type="primary", key=f"delete_arch_{convo_id}", use_container_width=True):
                             delete_conversation(convo_id)
-                            remember(user_id, META_SCOPE, f"convo_meta_{convo_id}", None)
                             st.rerun()
 
     st.sidebar.divider()
@@ -253,10 +252,14 @@ def show_sidebar(active_conversation_id):
         if st.button("Clear Chat History", use_container_width=True):
             if active_conversation_id:
                 clear_conversation(active_conversation_id)
+                # The chat view only fetches rows newer than what it holds, so drop its window.
+                st.session_state.pop("message_window", None)
                 st.rerun()
 
     st.sidebar.divider()
     if st.sidebar.button("Log Out", use_container_width=True):
+        end_session(st.session_state.get("session_token"))
+        forget_private(st.session_state.user_id)
         st.session_state.clear()
         st.rerun()
 